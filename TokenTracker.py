@@ -1,24 +1,176 @@
+import asyncio
+import threading
 import time
 from collections import deque
 
+WINDOW_SECONDS = 60
+
+
+class _Entry:
+    __slots__ = ("timestamp", "amount", "active")
+
+    def __init__(self, timestamp: float, amount: int):
+        self.timestamp = timestamp
+        self.amount = amount
+        self.active = True
+
+
+class SlidingWindow:
+    """Amounts recorded over the last WINDOW_SECONDS, with a running total kept on append and evict"""
+
+    def __init__(self, limit: int = 0, period: float = WINDOW_SECONDS):
+        self.limit = limit  # 0 means unlimited
+        self.period = period
+        self.entries = deque()
+        self.total = 0
+
+    def cleanup(self, current_time):
+        while self.entries and current_time - self.entries[0].timestamp > self.period:
+            entry = self.entries.popleft()
+            entry.active = False
+            self.total -= entry.amount
+
+    def fits(self, amount: int, current_time) -> bool:
+        self.cleanup(current_time)
+        return not self.limit or self.total + amount <= self.limit
+
+    def add(self, amount: int, current_time) -> _Entry:
+        entry = _Entry(current_time, amount)
+        self.entries.append(entry)
+        self.total += amount
+        return entry
+
+    def adjust(self, entry: _Entry, amount: int, current_time):
+        """Change the amount recorded for entry, or record the difference now if it already expired"""
+        if entry.active:
+            self.total += amount - entry.amount
+            entry.amount = amount
+        elif amount > entry.amount:
+            self.add(amount - entry.amount, current_time)
+
+
+class Reservation:
+    """Tokens held for one request; settle it with commit(actual_tokens) or refund()"""
+
+    def __init__(self, tracker, tokens: int, entries: list, shared: bool = False):
+        self.tracker = tracker
+        self.tokens = tokens
+        self.entries = entries  # [(window, entry, is_request_count)]
+        self.shared = shared  # taken from the backend, so unused tokens go back to it on settle
+        self.settled = False
+
+    def commit(self, actual_tokens: int):
+        self.tracker._settle(self, actual_tokens, keep_request=True)
+
+    def refund(self):
+        self.tracker._settle(self, 0, keep_request=False)
+
+
 class TokenUsageTracker:
-    def __init__(self, limit_per_minute):
+    """Per-process sliding-window limits, optionally backed by a budget shared across processes.
+
+    A backend must provide take(tokens), give(tokens), release() and get_stats(). take() returns
+    True when the tokens were taken, False when the shared budget has no room, and None when it
+    could not be checked; such requests are admitted on the local limits and give nothing back.
+    take() may block on I/O, so on the event loop use reserve(), which runs it in a thread.
+    """
+
+    def __init__(self, limit_per_minute, requests_per_minute: int = 0, session_limit_per_minute: int = 0, db_limit_per_minute: int = 0, backend=None):
         self.limit = limit_per_minute
-        self.usage_window = deque()  # Stores (timestamp, tokens_used)
+        self.backend = backend
+        self.session_limit = session_limit_per_minute
+        self.db_limit = db_limit_per_minute
+        self.usage_window = SlidingWindow(limit_per_minute)
+        self.request_window = SlidingWindow(requests_per_minute)
+        self.session_windows: dict[str, SlidingWindow] = {}
+        self.db_windows: dict[str, SlidingWindow] = {}
+        self.lock = threading.Lock()
 
-    def add_usage(self, tokens_used: int):
-        now = time.time()
-        self.usage_window.append((now, tokens_used))
-        self.cleanup(now)
+    @staticmethod
+    def _sub_window(windows: dict, key: str, limit: int, current_time) -> SlidingWindow:
+        window = windows.get(key)
+        if window is None:
+            # Drop idle sub-windows before the map grows without bound
+            if len(windows) >= 1024:
+                for idle_key in [k for k, w in windows.items() if w.fits(0, current_time) and not w.entries]:
+                    del windows[idle_key]
+            window = windows[key] = SlidingWindow(limit)
+        return window
 
-    def get_usage_total(self):
-        now = time.time()
-        self.cleanup(now)
-        return sum(tokens for timestamp, tokens in self.usage_window)
+    def try_reserve(self, tokens: int, session_id: str = None, db_name: str = None):
+        """Atomically check every limit and record the tokens; returns a Reservation or None if over a limit"""
+        with self.lock:
+            now = time.time()
+            checks = [(self.usage_window, tokens, False), (self.request_window, 1, True)]
+            if self.session_limit and session_id:
+                checks.append((self._sub_window(self.session_windows, session_id, self.session_limit, now), tokens, False))
+            if self.db_limit and db_name:
+                checks.append((self._sub_window(self.db_windows, db_name, self.db_limit, now), tokens, False))
 
-    def cleanup(self, current_time):
-        while self.usage_window and current_time - self.usage_window[0][0] > 60:
-            self.usage_window.popleft()
+            if not all(window.fits(amount, now) for window, amount, _ in checks):
+                return None
+            entries = [(window, window.add(amount, now), is_request) for window, amount, is_request in checks]
+
+        # The local windows are held while the backend is asked, outside the lock
+        taken = self.backend.take(tokens) if self.backend is not None else None
+        if taken is False:
+            with self.lock:
+                now = time.time()
+                for window, entry, _ in entries:
+                    window.adjust(entry, 0, now)
+            return None
+        return Reservation(self, tokens, entries, shared=bool(taken))
+
+    async def reserve(self, tokens: int, session_id: str = None, db_name: str = None):
+        """try_reserve for the event loop; with a shared backend it runs in a thread since leasing hits the database"""
+        if self.backend is None:
+            return self.try_reserve(tokens, session_id, db_name)
+        return await asyncio.to_thread(self.try_reserve, tokens, session_id, db_name)
+
+    def exceeds_limits(self, tokens: int) -> bool:
+        """True when tokens is larger than a whole window of the global, session or db limit, so it can never be reserved"""
+        return any(limit and tokens > limit for limit in (self.limit, self.session_limit, self.db_limit))
+
+    def sub_limited(self, tokens: int, session_id: str = None, db_name: str = None) -> bool:
+        """True when the session or db window, rather than the shared budget, has no room for tokens"""
+        with self.lock:
+            now = time.time()
+            for windows, key, limit in ((self.session_windows, session_id, self.session_limit), (self.db_windows, db_name, self.db_limit)):
+                window = windows.get(key) if limit and key else None
+                if window is not None and not window.fits(tokens, now):
+                    return True
+            return False
+
+    def _settle(self, reservation: Reservation, actual_tokens: int, keep_request: bool):
+        with self.lock:
+            if reservation.settled:
+                return
+            reservation.settled = True
+            now = time.time()
+            for window, entry, is_request in reservation.entries:
+                if is_request:
+                    if not keep_request:
+                        window.adjust(entry, 0, now)
+                else:
+                    window.adjust(entry, actual_tokens, now)
+            if reservation.shared:
+                self.backend.give(reservation.tokens - actual_tokens)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            now = time.time()
+            self.usage_window.cleanup(now)
+            self.request_window.cleanup(now)
+            return {
+                "tokens_last_minute": self.usage_window.total,
+                "token_limit": self.limit,
+                "requests_last_minute": self.request_window.total,
+                "request_limit": self.request_window.limit,
+                "tracked_sessions": len(self.session_windows),
+                "tracked_databases": len(self.db_windows),
+                "backend": self.backend.get_stats() if self.backend is not None else None,
+            }
 
-    def can_process(self, tokens_needed: int):
-        return self.get_usage_total() + tokens_needed <= self.limit
\ No newline at end of file
+    def close(self):
+        if self.backend is not None:
+            self.backend.release()
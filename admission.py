@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+
+from settings import get_settings
+from llm_logger import get_logger
+from TokenTracker import TokenUsageTracker
+
+settings = get_settings()
+logger = get_logger()
+
+
+class _Waiter:
+    __slots__ = ("key", "tokens", "session_id", "db_name", "future", "enqueued_at", "active")
+
+    def __init__(self, key: tuple, tokens: int, session_id: str, db_name: str):
+        self.key = key
+        self.tokens = tokens
+        self.session_id = session_id
+        self.db_name = db_name
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.active = True
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class AdmissionQueue:
+    """Holds /query requests until the token tracker can reserve their budget.
+
+    Waiters are ordered by priority, then by how many requests the same session
+    already has queued (so one session cannot starve the others), then by arrival.
+    Waiters are tried in that order; one held back only by its own session or db limit
+    is skipped, while one held back by the shared budget stops the scan so smaller
+    requests behind it cannot overtake it indefinitely.
+    """
+
+    def __init__(self, tracker: TokenUsageTracker, max_depth: int, max_wait: float, poll_interval: float, position_interval: float):
+        self.tracker = tracker
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.position_interval = position_interval
+        self._heap: list[_Waiter] = []
+        self._waiting = 0
+        self._session_counts = Counter()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._recent_waits = deque(maxlen=200)
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "too_large": 0, "timed_out": 0, "max_wait": 0.0}
+
+    def notify(self):
+        """Called when budget may have been freed, e.g. a reservation was settled"""
+        self._wakeup.set()
+
+    def _position(self, waiter: _Waiter) -> int:
+        return 1 + sum(1 for other in self._heap if other.active and other.key < waiter.key)
+
+    def _leave(self, waiter: _Waiter):
+        if waiter.active:
+            waiter.active = False
+            self._waiting -= 1
+            self._session_counts[waiter.session_id] -= 1
+            if self._session_counts[waiter.session_id] <= 0:
+                del self._session_counts[waiter.session_id]
+
+    def _record_wait(self, waited: float):
+        self._recent_waits.append(waited)
+        self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+
+    def too_large(self, tokens: int) -> bool:
+        """Requests that no amount of waiting could admit; reject them instead of queueing"""
+        if self.tracker.exceeds_limits(tokens):
+            self.stats["too_large"] += 1
+            return True
+        return False
+
+    async def admit(self, tokens: int, session_id: str, db_name: str, priority: int = 0):
+        """Yields ("queued", position) while waiting, then ("admitted", reservation), ("rejected", None) or ("timeout", None)"""
+        if self.too_large(tokens):
+            logger.error(f"(API) Request of {tokens} tokens exceeds the token limits. Request denied.")
+            yield "rejected", None
+            return
+
+        if not self._waiting:
+            # Shielded: with a shared backend the reservation finishes in a thread even if this request
+            # is cancelled meanwhile, and must then be refunded rather than leak
+            reserving = asyncio.ensure_future(self.tracker.reserve(tokens, session_id=session_id, db_name=db_name))
+            try:
+                reservation = await asyncio.shield(reserving)
+            except asyncio.CancelledError:
+                reserving.add_done_callback(self._refund_abandoned)
+                raise
+            if reservation is not None:
+                self.stats["admitted"] += 1
+                self._record_wait(0.0)
+                yield "admitted", reservation
+                return
+
+        if self._waiting >= self.max_depth:
+            self.stats["rejected"] += 1
+            logger.error(f"(API) Admission queue full ({self._waiting}). Request denied.")
+            yield "rejected", None
+            return
+
+        key = (-priority, self._session_counts[session_id], next(self._seq))
+        waiter = _Waiter(key, tokens, session_id, db_name)
+        heapq.heappush(self._heap, waiter)
+        self._waiting += 1
+        self._session_counts[session_id] += 1
+        self.stats["queued"] += 1
+        self._ensure_dispatcher()
+
+        deadline = waiter.enqueued_at + self.max_wait
+        handed_over = False
+        try:
+            while True:
+                yield "queued", self._position(waiter)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=min(remaining, self.position_interval))
+                except asyncio.TimeoutError:
+                    continue
+                waited = time.monotonic() - waiter.enqueued_at
+                self._record_wait(waited)
+                logger.info(f"(API) Request admitted after {waited:.2f}s in queue")
+                handed_over = True
+                yield "admitted", waiter.future.result()
+                return
+
+            self.stats["timed_out"] += 1
+            logger.error(f"(API) Request timed out after {self.max_wait}s in admission queue.")
+            yield "timeout", None
+        finally:
+            self._leave(waiter)
+            # A reservation made for a client that went away must not keep holding budget
+            if not handed_over and waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().refund()
+                self.notify()
+            elif not waiter.future.done():
+                waiter.future.cancel()
+
+    def _refund_abandoned(self, reserving: asyncio.Future):
+        if not reserving.cancelled() and reserving.exception() is None and reserving.result() is not None:
+            reserving.result().refund()
+            self.notify()
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="admission-dispatcher")
+
+    async def _dispatch(self):
+        while True:
+            self._heap = [waiter for waiter in self._heap if waiter.active and not waiter.future.done()]
+            if not self._heap:
+                return
+            heapq.heapify(self._heap)
+
+            for waiter in sorted(self._heap):
+                if waiter.future.done():
+                    continue
+                reservation = await self.tracker.reserve(waiter.tokens, session_id=waiter.session_id, db_name=waiter.db_name)
+                if reservation is not None and waiter.future.done():
+                    # The waiter timed out or disconnected while the budget was being reserved
+                    reservation.refund()
+                elif reservation is not None:
+                    self.stats["admitted"] += 1
+                    waiter.future.set_result(reservation)
+                elif not self.tracker.sub_limited(waiter.tokens, waiter.session_id, waiter.db_name):
+                    break
+            if all(waiter.future.done() for waiter in self._heap):
+                continue
+
+            # The window frees budget as time passes, so poll even without a notification
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> dict:
+        waits = sorted(self._recent_waits)
+        return {
+            **self.stats,
+            "queue_length": self._waiting,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+        }
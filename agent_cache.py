@@ -0,0 +1,56 @@
+import hashlib
+from collections import OrderedDict
+from typing import Callable
+
+from settings import get_settings
+from llm_logger import get_logger
+
+settings = get_settings()
+logger = get_logger()
+
+
+class AgentCache:
+    """LRU cache of compiled react agents keyed by db_name, system prompt and tool set"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._agents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(db_name: str, system_prompt: str, tools: list) -> tuple:
+        prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        # Tools are bound to a specific MCP session, so a reconnect yields new objects and a new key;
+        # cached agents keep their tools alive, so ids cannot be reused while an entry exists
+        tool_set = tuple((tool.name, id(tool)) for tool in tools)
+        return db_name, prompt_hash, tool_set
+
+    def get_or_create(self, db_name: str, system_prompt: str, tools: list, factory: Callable):
+        key = self.make_key(db_name, system_prompt, tools)
+        agent = self._agents.get(key)
+        if agent is not None:
+            self.hits += 1
+            self._agents.move_to_end(key)
+            return agent
+
+        self.misses += 1
+        agent = factory()
+        self._agents[key] = agent
+        if len(self._agents) > self.max_size:
+            self._agents.popitem(last=False)
+            self.evictions += 1
+        return agent
+
+    def get_stats(self) -> dict:
+        return {
+            "size": len(self._agents),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+agent_cache = AgentCache(max_size=settings.AGENT_CACHE_SIZE)
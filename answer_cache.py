@@ -0,0 +1,140 @@
+import re
+import json
+import time
+import asyncio
+from collections import OrderedDict
+
+from settings import get_settings
+from llm_logger import get_logger
+from embeddings import get_embedder
+
+settings = get_settings()
+logger = get_logger()
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    return WHITESPACE_PATTERN.sub(" ", prompt).strip().lower().rstrip("?!. ")
+
+
+class AnswerCache:
+    """Opt-in cache of final answers for repeated questions, keyed by db_name, schema fingerprint and prompt.
+
+    Only first turns without an uploaded file are cached (see prepare_request), since the key
+    does not capture conversation history or file context.
+
+    Exact matches on the normalised prompt are checked first; with similarity > 0, the closest
+    cached question for the same database and schema is used when its cosine similarity reaches
+    that threshold. Entries expire after `ttl` seconds; data changes that do not touch the schema
+    must be signalled through invalidate().
+    """
+
+    def __init__(self, max_size: int, ttl: float, similarity: float, excluded_tools: set[str]):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.excluded_tools = excluded_tools
+        # (db_name, fingerprint, normalized prompt) -> {"answer", "created_at", "vector"}
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "skipped": 0, "invalidated": 0}
+
+    def _live(self, key) -> dict:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["created_at"] > self.ttl:
+            del self._entries[key]
+            return None
+        return entry
+
+    async def _embed(self, text: str):
+        # Only used when ANSWER_CACHE_SIMILARITY is set, so numpy is not imported otherwise
+        import numpy as np
+        try:
+            return np.asarray(await get_embedder().embed_query(text), dtype=np.float32)
+        except Exception as e:
+            logger.error(f"(API) Answer cache embedding failed: {e}")
+            return None
+
+    async def lookup(self, prompt: str, db_name: str, fingerprint: str):
+        """The cached answer for this question, or None"""
+        if fingerprint is None:
+            return None
+        normalized = normalize_prompt(prompt)
+        key = (db_name, fingerprint, normalized)
+        entry = self._live(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return entry["answer"]
+
+        if self.similarity > 0:
+            vector = await self._embed(normalized)
+            if vector is not None:
+                best_key, best_score = None, self.similarity
+                for other_key in list(self._entries):
+                    if other_key[:2] != (db_name, fingerprint):
+                        continue
+                    other = self._live(other_key)
+                    if other is None or other["vector"] is None:
+                        continue
+                    score = float(other["vector"] @ vector)
+                    if score >= best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None:
+                    self.stats["similar_hits"] += 1
+                    self._entries.move_to_end(best_key)
+                    logger.info(f"(API) Answer cache similar hit ({best_score:.3f}): {best_key[2]!r}")
+                    return self._entries[best_key]["answer"]
+
+        self.stats["misses"] += 1
+        return None
+
+    async def store(self, prompt: str, db_name: str, fingerprint: str, answer: str, tools_used: set[str]):
+        if fingerprint is None or not answer.strip() or tools_used & self.excluded_tools:
+            # Answers that produced a download link or similar side effect must not be replayed
+            self.stats["skipped"] += 1
+            return
+        normalized = normalize_prompt(prompt)
+        vector = await self._embed(normalized) if self.similarity > 0 else None
+        key = (db_name, fingerprint, normalized)
+        self._entries[key] = {"answer": answer, "created_at": time.monotonic(), "vector": vector}
+        self._entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, db_name: str = None) -> int:
+        """Drop cached answers for db_name, or all of them; call when the underlying data changes"""
+        if db_name is None:
+            removed = len(self._entries)
+            self._entries.clear()
+        else:
+            keys = [key for key in self._entries if key[0] == db_name]
+            for key in keys:
+                del self._entries[key]
+            removed = len(keys)
+        self.stats["invalidated"] += removed
+        logger.info(f"(API) Invalidated {removed} cached answers for: {db_name or 'all databases'}")
+        return removed
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "enabled": settings.ANSWER_CACHE_ENABLED, "size": len(self._entries)}
+
+
+async def replay_answer(answer: str):
+    """Stream a cached answer with the same frames run_agent produces"""
+    size = settings.ANSWER_CACHE_REPLAY_CHUNK_SIZE
+    for start in range(0, len(answer), size):
+        yield f"data: {answer[start:start + size]}\n\n"
+        await asyncio.sleep(0)
+    yield f"event: end\ndata: {json.dumps({'message': 'stream complete'})}\n\n"
+
+
+answer_cache = AnswerCache(
+    max_size=settings.ANSWER_CACHE_SIZE,
+    ttl=settings.ANSWER_CACHE_TTL,
+    similarity=settings.ANSWER_CACHE_SIMILARITY,
+    excluded_tools={tool.strip() for tool in settings.ANSWER_CACHE_EXCLUDED_TOOLS.split(",") if tool.strip()},
+)
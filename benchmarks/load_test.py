@@ -0,0 +1,92 @@
+"""Concurrent /query load test.
+
+Opens many SSE streams against a running API and reports time to first
+frame, total stream time and the largest gap between frames per stream.
+Stalls of the event loop (e.g. a blocking database call) show up as a
+high p99 gap across all concurrent streams.
+
+    python benchmarks/load_test.py --url http://localhost:8003 --users 50 --requests 4
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run_stream(client: httpx.AsyncClient, url: str, prompt: str, session_id: str, db_name: str) -> dict:
+    start = time.perf_counter()
+    first_frame = None
+    last_frame = start
+    max_gap = 0.0
+    frames = 0
+    errors = 0
+
+    params = {"prompt": prompt, "session_id": session_id, "db_name": db_name}
+    async with client.stream("GET", f"{url}/query", params=params) as response:
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            now = time.perf_counter()
+            if first_frame is None:
+                first_frame = now - start
+            max_gap = max(max_gap, now - last_frame)
+            last_frame = now
+            frames += 1
+            if line.startswith("event: error") or line.startswith("RATE_LIMIT_ERROR"):
+                errors += 1
+
+    return {
+        "first_frame": first_frame if first_frame is not None else time.perf_counter() - start,
+        "total": time.perf_counter() - start,
+        "max_gap": max_gap,
+        "frames": frames,
+        "errors": errors,
+    }
+
+
+async def run_user(client: httpx.AsyncClient, args) -> list[dict]:
+    session_id = str(uuid.uuid4())
+    results = []
+    for _ in range(args.requests):
+        results.append(await run_stream(client, args.url, args.prompt, session_id, args.db_name))
+    return results
+
+
+async def main(args):
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        per_user = await asyncio.gather(*(run_user(client, args) for _ in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+    results = [result for user_results in per_user for result in user_results]
+    print(f"{len(results)} streams from {args.users} concurrent users in {elapsed:.2f}s")
+    print(f"errors: {sum(r['errors'] for r in results)}, frames: {sum(r['frames'] for r in results)}")
+    for metric in ("first_frame", "max_gap", "total"):
+        values = [r[metric] for r in results]
+        print(
+            f"{metric:>12}: p50={percentile(values, 50):.3f}s "
+            f"p95={percentile(values, 95):.3f}s p99={percentile(values, 99):.3f}s max={max(values):.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8003")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=3, help="sequential requests per user")
+    parser.add_argument("--prompt", default="How many tables do we have?")
+    parser.add_argument("--db-name", default="main")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,115 @@
+"""SSE frame coalescing benchmark.
+
+Serves synthetic token streams from an in-process uvicorn server, once with one
+frame per token (the old run_agent behaviour) and once through coalesce_sse, and
+reads them back over HTTP with many concurrent clients. Reports frames sent,
+token throughput and time to first frame for each mode.
+
+    python benchmarks/sse_benchmark.py --streams 200 --tokens 500 --token-delay-ms 2
+"""
+import argparse
+import asyncio
+import random
+import socket
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from load_test import percentile  # noqa: E402
+from sse_writer import coalesce_sse, data_frame  # noqa: E402
+
+
+def build_app(args) -> FastAPI:
+    app = FastAPI()
+
+    async def tokens():
+        for i in range(args.tokens):
+            await asyncio.sleep(random.uniform(0, 2 * args.token_delay_ms / 1000))
+            yield f"tok{i} "
+
+    async def per_token():
+        async for token in tokens():
+            yield data_frame(token)
+
+    async def coalesced():
+        async for frame in coalesce_sse(tokens(), args.flush_ms / 1000, args.flush_bytes, 0):
+            yield frame
+
+    @app.get("/raw")
+    async def raw_stream():
+        return StreamingResponse(per_token(), media_type="text/event-stream")
+
+    @app.get("/coalesced")
+    async def coalesced_stream():
+        return StreamingResponse(coalesced(), media_type="text/event-stream")
+
+    return app
+
+
+async def read_stream(client: httpx.AsyncClient, url: str) -> dict:
+    start = time.perf_counter()
+    first_frame = None
+    frames = 0
+    async with client.stream("GET", url) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            if first_frame is None:
+                first_frame = time.perf_counter() - start
+            frames += 1
+    return {"first_frame": first_frame or 0.0, "frames": frames, "total": time.perf_counter() - start}
+
+
+async def run_mode(base_url: str, path: str, args):
+    limits = httpx.Limits(max_connections=args.streams, max_keepalive_connections=args.streams)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(read_stream(client, f"{base_url}{path}") for _ in range(args.streams)))
+        elapsed = time.perf_counter() - started
+
+    frames = sum(r["frames"] for r in results)
+    first = [r["first_frame"] for r in results]
+    print(
+        f"{path:>11}: {elapsed:.2f}s, {frames} frames ({frames / args.streams:.0f}/stream), "
+        f"{args.streams * args.tokens / elapsed:.0f} tokens/s, first frame "
+        f"p50={percentile(first, 50) * 1000:.1f}ms p99={percentile(first, 99) * 1000:.1f}ms"
+    )
+
+
+async def main(args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    config = uvicorn.Config(build_app(args), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"{args.streams} concurrent streams x {args.tokens} tokens, ~{args.token_delay_ms}ms between tokens")
+    try:
+        for path in ("/raw", "/coalesced"):
+            await run_mode(base_url, path, args)
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--token-delay-ms", type=float, default=2.0, help="mean delay between tokens")
+    parser.add_argument("--flush-ms", type=float, default=50.0)
+    parser.add_argument("--flush-bytes", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(main(parser.parse_args()))
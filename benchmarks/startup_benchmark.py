@@ -0,0 +1,136 @@
+"""API cold-start benchmark.
+
+Imports `main` in fresh interpreters with `-X importtime` and reports the total
+import time, the slowest modules (cumulative) and any heavy dependency that is
+imported eagerly although it should only load on first use. With --serve it also
+starts `uvicorn main:app` (needs the database and .env) and measures the time
+until the first request succeeds, which includes the lifespan hook.
+
+Exits non-zero when --max-import-ms is exceeded or a lazy module is imported on
+startup, so it can guard against regressions in CI.
+
+    python benchmarks/startup_benchmark.py --runs 5 --max-import-ms 1500
+    python benchmarks/startup_benchmark.py --serve --runs 3
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from load_test import percentile  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+# Loaded on first use (or by the warm-up task after startup), never by `import main`
+LAZY_MODULES = (
+    "pandas", "numpy", "PyPDF2", "tiktoken", "openai", "langchain_openai", "langgraph",
+    "langchain_postgres", "langchain_text_splitters", "mcp", "langchain_mcp_adapters",
+)
+
+
+def measure_imports() -> dict:
+    """module -> (self us, cumulative us, depth) for one cold `import main`"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(f"import main failed:\n{result.stderr[-2000:]}")
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+def run_imports(args) -> bool:
+    runs = [measure_imports() for _ in range(args.runs)]
+    totals = [run["main"][1] / 1000 for run in runs]
+    last = runs[-1]
+
+    print(f"import main: median {statistics.median(totals):.0f}ms, min {min(totals):.0f}ms over {args.runs} runs")
+    print("\nslowest modules by cumulative time (last run):")
+    slowest = sorted(last.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_us, cumulative_us, depth) in slowest[1:args.top + 1]:
+        print(f"  {cumulative_us / 1000:8.1f}ms  {self_us / 1000:7.1f}ms self  {'  ' * depth}{name}")
+
+    project = sorted(
+        (name for name in last if (ROOT / f"{name}.py").exists()),
+        key=lambda name: last[name][1], reverse=True,
+    )
+    print("\nproject modules (cumulative / self):")
+    for name in project:
+        print(f"  {last[name][1] / 1000:8.1f}ms  {last[name][0] / 1000:7.1f}ms  {name}")
+
+    ok = True
+    eager = [name for name in LAZY_MODULES if name in last]
+    if eager:
+        ok = False
+        print(f"\nFAIL: imported on startup but should load lazily: {', '.join(eager)}")
+    if args.max_import_ms and statistics.median(totals) > args.max_import_ms:
+        ok = False
+        print(f"\nFAIL: median import time above {args.max_import_ms}ms")
+    return ok
+
+
+def time_to_first_request(args) -> float:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=os.environ.copy(),
+    )
+    try:
+        deadline = start + args.timeout
+        while time.perf_counter() < deadline:
+            if server.poll() is not None:
+                sys.exit(f"uvicorn exited with code {server.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}{args.path}", timeout=1.0).status_code < 500:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        sys.exit(f"no response from {args.path} within {args.timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_serve(args):
+    timings = [time_to_first_request(args) for _ in range(args.runs)]
+    print(
+        f"\ntime to first request ({args.path}): median {statistics.median(timings) * 1000:.0f}ms, "
+        f"p90 {percentile(timings, 90) * 1000:.0f}ms, min {min(timings) * 1000:.0f}ms over {args.runs} runs"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules to list")
+    parser.add_argument("--max-import-ms", type=float, default=0, help="fail above this median; 0 disables")
+    parser.add_argument("--serve", action="store_true", help="also measure time to first request with uvicorn")
+    parser.add_argument("--path", default="/admin/metrics", help="endpoint polled by --serve")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    ok = run_imports(args)
+    if args.serve:
+        run_serve(args)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,178 @@
+import asyncio
+import json
+
+import xxhash
+import zstandard
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_connection
+
+settings = get_settings()
+logger = get_logger()
+
+_stats = {"stored": 0, "deduplicated": 0, "migrated_uploads": 0, "migrated_modified_files": 0, "migration_failures": 0}
+
+
+def new_hasher():
+    return xxhash.xxh3_128()
+
+
+def hash_bytes(data: bytes) -> str:
+    return xxhash.xxh3_128_hexdigest(data)
+
+
+def compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=settings.UPLOAD_COMPRESSION_LEVEL).compress(data)
+
+
+def decompress(data: bytes) -> bytes:
+    # decompressobj also handles frames written by a streaming compressor, which carry no content size
+    return zstandard.ZstdDecompressor().decompressobj().decompress(bytes(data))
+
+
+async def lock_blob(cur, digest: str) -> bool:
+    """Keep the unreferenced-blob cleanup off an existing blob until this transaction ends; False when it is gone"""
+    await cur.execute("SELECT 1 FROM blobs WHERE hash = %s FOR KEY SHARE;", (digest,))
+    return await cur.fetchone() is not None
+
+
+async def put_blob(cur, digest: str, size: int, compressed: bytes) -> bool:
+    """Store a zstd-compressed payload under its content hash; False when it was already stored.
+
+    An existing blob is locked for the rest of the transaction, so the cleanup cannot delete it
+    before the row referencing it commits. When the cleanup wins, the insert is retried.
+    """
+    while True:
+        await cur.execute("""
+            INSERT INTO blobs (hash, size, stored_size, data)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (hash) DO NOTHING;
+        """, (digest, size, len(compressed), compressed))
+        inserted = cur.rowcount == 1
+        if inserted or await lock_blob(cur, digest):
+            break
+    _stats["stored" if inserted else "deduplicated"] += 1
+    return inserted
+
+
+async def put_bytes(cur, data: bytes) -> str:
+    digest = hash_bytes(data)
+    await put_blob(cur, digest, len(data), await asyncio.to_thread(compress, data))
+    return digest
+
+
+async def _migrate_upload(cur, row):
+    id, data, kind, parsed_content, raw_content = row
+    if parsed_content is not None:
+        parsed = decompress(parsed_content)
+        raw = decompress(raw_content) if raw_content is not None else None
+    else:
+        # Uploads stored before parsing: a JSON string holding the decoded text
+        text = data if isinstance(data, str) else json.dumps(data)
+        parsed = raw = text.encode("utf-8")
+        kind = "text"
+
+    parsed_blob = await put_bytes(cur, parsed)
+    raw_blob = await put_bytes(cur, raw) if raw is not None else None
+    await cur.execute("""
+        UPDATE uploaded_files
+        SET parsed_blob = %s, raw_blob = %s, content_kind = %s, byte_size = COALESCE(byte_size, %s),
+            data = NULL, parsed_content = NULL, raw_content = NULL
+        WHERE id = %s;
+    """, (parsed_blob, raw_blob, kind, len(raw if raw is not None else parsed), id))
+
+
+async def _migrate_modified_file(cur, row):
+    id, content = row
+    content_blob = await put_bytes(cur, bytes(content))
+    await cur.execute("UPDATE modified_files SET content_blob = %s, content = NULL WHERE id = %s;", (content_blob, id))
+
+
+async def migrate_to_blobs(batch_size: int = settings.BLOB_MIGRATION_BATCH_SIZE) -> dict:
+    """Move inline file content of both tables into the blob store, one batch per transaction.
+
+    modified_files rows are written by the MCP server with inline content, so this also runs
+    periodically to pick up new exports. SKIP LOCKED lets several API workers run it at once.
+    """
+    migrated = {"uploaded_files": 0, "modified_files": 0}
+    jobs = (
+        ("uploaded_files", """
+            SELECT id, data, content_kind, parsed_content, raw_content FROM uploaded_files
+            WHERE parsed_blob IS NULL AND (data IS NOT NULL OR parsed_content IS NOT NULL)
+            ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED;
+        """, _migrate_upload, "migrated_uploads"),
+        ("modified_files", """
+            SELECT id, content FROM modified_files
+            WHERE content_blob IS NULL AND content IS NOT NULL
+            ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED;
+        """, _migrate_modified_file, "migrated_modified_files"),
+    )
+    for table, select_sql, migrate_row, stat in jobs:
+        while True:
+            try:
+                async with get_async_connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(select_sql, (batch_size,))
+                        rows = await cur.fetchall()
+                        for row in rows:
+                            await migrate_row(cur, row)
+            except Exception as e:
+                _stats["migration_failures"] += 1
+                logger.error(f"(API) Blob migration of {table} failed: {e}")
+                break
+            migrated[table] += len(rows)
+            _stats[stat] += len(rows)
+            if len(rows) < batch_size:
+                break
+
+    if any(migrated.values()):
+        logger.info(f"(API) Migrated file content into blobs: {migrated}")
+    return migrated
+
+
+async def storage_report() -> dict:
+    """Logical bytes referenced by both tables against the bytes the blob store actually holds"""
+    async with get_async_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                WITH refs AS (
+                    SELECT raw_blob AS hash FROM uploaded_files WHERE raw_blob IS NOT NULL
+                    UNION ALL
+                    SELECT parsed_blob FROM uploaded_files WHERE parsed_blob IS NOT NULL
+                    UNION ALL
+                    SELECT content_blob FROM modified_files WHERE content_blob IS NOT NULL
+                )
+                SELECT
+                    (SELECT count(*) FROM blobs),
+                    (SELECT coalesce(sum(size), 0) FROM blobs),
+                    (SELECT coalesce(sum(stored_size), 0) FROM blobs),
+                    (SELECT count(*) FROM refs),
+                    (SELECT coalesce(sum(b.size), 0) FROM refs JOIN blobs b USING (hash)),
+                    (SELECT count(*) FROM uploaded_files WHERE parsed_blob IS NULL AND (data IS NOT NULL OR parsed_content IS NOT NULL)),
+                    (SELECT count(*) FROM modified_files WHERE content_blob IS NULL AND content IS NOT NULL);
+            """)
+            blobs, unique_bytes, stored_bytes, references, referenced_bytes, pending_uploads, pending_modified = await cur.fetchone()
+
+    return {
+        "blobs": blobs,
+        "references": references,
+        "referenced_bytes": referenced_bytes,
+        "unique_bytes": unique_bytes,
+        "stored_bytes": stored_bytes,
+        "saved_by_dedup": referenced_bytes - unique_bytes,
+        "saved_by_compression": unique_bytes - stored_bytes,
+        "saved_total": referenced_bytes - stored_bytes,
+        "pending_migration": {"uploaded_files": pending_uploads, "modified_files": pending_modified},
+    }
+
+
+async def run_blob_migrator():
+    """Background task started from the lifespan hook"""
+    while True:
+        await migrate_to_blobs()
+        await asyncio.sleep(settings.BLOB_MIGRATION_INTERVAL)
+
+
+def blob_store_stats() -> dict:
+    return dict(_stats)
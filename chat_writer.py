@@ -0,0 +1,154 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+from psycopg import sql
+from langchain_core.messages import BaseMessage, message_to_dict
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_connection
+from db_memory import remember_messages, forget_messages
+
+settings = get_settings()
+logger = get_logger()
+
+_STOP = object()
+
+
+class ChatWriteBehind:
+    """Persists end-of-chat history messages and llm_logs rows in batches from a background task.
+
+    submit() never waits on the database. Records are buffered on a bounded queue,
+    written in one transaction per batch with retries, and drained on close(). When the
+    queue is full (the database is down or far behind) new records are dropped and counted,
+    so memory and pool connections stay bounded.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue_size: int, max_retries: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self._worker = None
+        self.stats = {"submitted": 0, "written": 0, "failed": 0, "retries": 0, "dropped": 0}
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name="chat-write-behind")
+
+    def submit(self, session_id: str, messages: list[BaseMessage], model_name: str, prompt: str, response: str,
+               input_tokens: int, output_tokens: int, total_tokens: int, tool_name: str = None, cached_tokens: int = None, cache_hit: bool = False):
+        record = {
+            "session_id": session_id,
+            "messages": [json.dumps(message_to_dict(message)) for message in messages],
+            # Added to the session's cached history once written, so the cache never runs ahead of the table
+            "history": messages,
+            "llm_log": (
+                datetime.now(timezone.utc), model_name, prompt, response, input_tokens, output_tokens, total_tokens, tool_name,
+                cached_tokens, cache_hit
+            ),
+        }
+        self.start()
+        self.stats["submitted"] += 1
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            forget_messages(session_id)
+            logger.error(f"(API) Chat write queue full ({self.queue.maxsize}), dropping record for session {session_id}")
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write_with_retry(batch)
+
+        # Drain anything queued behind the stop marker
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            await self._write_with_retry(remaining[start:start + self.batch_size])
+
+    async def _write_with_retry(self, batch: list[dict]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._write_batch(batch)
+                self.stats["written"] += len(batch)
+                for record in batch:
+                    remember_messages(record["session_id"], record["history"])
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"(API) Failed to persist {len(batch)} chat records after {attempt + 1} attempts: {e}")
+                    await self._write_individually(batch)
+                    return
+                self.stats["retries"] += 1
+                await asyncio.sleep(min(2 ** attempt * 0.5, 10))
+
+    async def _write_individually(self, batch: list[dict]):
+        """Isolate a bad record so it does not take the rest of its batch down with it"""
+        if len(batch) == 1:
+            self.stats["failed"] += 1
+            forget_messages(batch[0]["session_id"])
+            return
+        for record in batch:
+            try:
+                await self._write_batch([record])
+                self.stats["written"] += 1
+                remember_messages(record["session_id"], record["history"])
+            except Exception as e:
+                self.stats["failed"] += 1
+                forget_messages(record["session_id"])
+                logger.error(f"(API) Dropping chat record for session {record['session_id']}: {e}")
+
+    async def _write_batch(self, batch: list[dict]):
+        history_rows = [(record["session_id"], message) for record in batch for message in record["messages"]]
+        log_rows = [record["llm_log"] for record in batch]
+        insert_history = sql.SQL("INSERT INTO {table} (session_id, message) VALUES (%s, %s)").format(
+            table=sql.Identifier(settings.DB_CHAT_HISTORY_TABLE)
+        )
+        async with get_async_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(insert_history, history_rows)
+                await cur.executemany("""
+                    INSERT INTO llm_logs (timestamp, model_name, prompt, response, input_tokens, output_tokens, total_tokens, tool_name, cached_tokens, cache_hit)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                """, log_rows)
+
+    async def close(self):
+        """Flush every buffered record; called from the lifespan shutdown"""
+        if self._worker is not None and not self._worker.done():
+            await self.queue.put(_STOP)
+            await self._worker
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "queued": self.queue.qsize()}
+
+
+chat_writer = ChatWriteBehind(
+    batch_size=settings.CHAT_WRITE_BATCH_SIZE,
+    flush_interval=settings.CHAT_WRITE_FLUSH_INTERVAL,
+    max_queue_size=settings.CHAT_WRITE_QUEUE_SIZE,
+    max_retries=settings.CHAT_WRITE_MAX_RETRIES,
+)
@@ -1,92 +1,160 @@
-from mcp import ClientSession
-from mcp.client.streamable_http import streamablehttp_client
-from langchain_mcp_adapters.tools import load_mcp_tools
-from langgraph.prebuilt import create_react_agent
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, AIMessage 
-from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_core.messages import HumanMessage, SystemMessage
 import traceback
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+import importlib
 import time
-import openai
+import asyncio
 import json
+from functools import lru_cache
+from typing import Callable
 
-from llm_logger import LLMLogger
-from settings import Settings
-from db_memory import get_session_history
+from llm_logger import get_logger
+from settings import get_settings
+from db_memory import get_recent_messages
 from prompts import sql_generation_template
-from user_repository import UserRepository
+from schema_cache import get_prompt_schema, get_schema_tool, get_schema_fingerprint
+from answer_cache import answer_cache
+from sse_writer import coalesce_sse
+from mcp_sessions import mcp_sessions
+from agent_cache import agent_cache
 from file_upload import get_uploaded_data
+from token_counter import count_prompt_tokens, count_message_tokens, get_encoding
+from file_context import build_file_context
+from doc_index import search_upload
 
 
-settings = Settings()
+settings = get_settings()
 
-logger = LLMLogger()
+logger = get_logger()
 
 
-model = ChatOpenAI(model="gpt-4.1", streaming=True, verbose=True, stream_usage=True)
+@lru_cache(maxsize=1)
+def get_model():
+    """The chat model, built once by the lifespan hook; langchain_openai and openai load here, not on import"""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=settings.LLM_MODEL, streaming=True, verbose=True, stream_usage=True)
 # tool = {"type": "web_search_preview"}
 # model = model.bind_tools([tool])
-     
-async def run_agent(prompt: str, session_id: str = "default", db_name: str = settings.DB_NAME):   
-    try:
-        logger.info(f"Using LLM Model: {model.model_name}")
-        logger.info(f"User Prompt: {prompt}")
-        start_time = time.perf_counter()
-        async with streamablehttp_client(url=settings.MCP_SERVER_URL,headers={'db_name':db_name}) as (read, write, _):
-            async with ClientSession(read, write) as session:
-                setup_time = time.perf_counter()
-                await session.initialize()
-
-                tools = await load_mcp_tools(session)  
-                #web_search_tool = {"type": "web_search_preview"}
-                #all_tools = tools + [web_search_tool]
 
-                #model = model.bind_tools(web_search_tool)
 
-                file_context = get_uploaded_data(session_id)
-                agent_prompt, combined_prompt = create_prompt(db_name, file_context)
-                combined_prompt += prompt
-                agent = create_react_agent(model, tools, prompt=agent_prompt)
+def warm_up():
+    """Import what the first /query needs and load the tokenizer; run in a thread after startup"""
+    importlib.import_module("langgraph.prebuilt")
+    importlib.import_module("langchain_core.prompts")
+    get_encoding()
 
-                history = get_session_history(session_id)
-                messages = history.messages[-settings.MEMORY_LIMIT:]
-                messages.append(HumanMessage(content=prompt))
 
-                full_response = ""
-                input_tokens = None
-                output_tokens = None
-                total_tokens = None
-                tool_name = None
-
-                finish_setup = time.perf_counter() - setup_time
-                logger.info(f'(API) Pre Streaming Setup Time: {finish_setup}')
-
-                stream_time_start = time.perf_counter()
+async def prepare_request(prompt: str, session_id: str, db_name: str) -> dict:
+    """Build the system prompt and trimmed history for a request and estimate its token cost"""
+    file_context, messages = await asyncio.gather(
+        get_uploaded_data(session_id),
+        get_recent_messages(session_id),
+    )
+    agent_prompt, system_prompt, context = await create_prompt(db_name, file_context, prompt)
+    # Answers that depend on an uploaded file or on earlier turns are never served from the answer cache
+    cacheable = not file_context and not messages
+
+    # Per-question context goes after the history so the system prompt and history stay a cacheable prefix
+    if context:
+        messages.append(SystemMessage(content=context))
+    messages.append(HumanMessage(content=prompt))
+
+    # The react loop re-sends the system prompt and history on every model call
+    input_tokens = count_prompt_tokens(system_prompt) + count_message_tokens(messages)
+    estimated_tokens = input_tokens * settings.TOKEN_ESTIMATE_MODEL_CALLS + settings.TOKEN_ESTIMATE_OUTPUT_TOKENS
+
+    return {
+        "agent_prompt": agent_prompt,
+        "system_prompt": system_prompt,
+        "context": context,
+        "messages": messages,
+        "cacheable": cacheable,
+        "schema_fingerprint": get_schema_fingerprint(db_name),
+        "estimated_tokens": estimated_tokens,
+    }
 
-                async for event in agent.astream_events({"messages": messages}, version="v2"):  
+     
+async def run_agent(prompt: str, session_id: str = "default", db_name: str = settings.DB_NAME, request: dict = None, on_usage: Callable[[int], None] = None):   
+    consumed_tokens = 0
+    model = get_model()
+    try:
+        logger.info(f"Using LLM Model: {model.model_name}")
+        logger.info(f"User Prompt: {prompt}")
+        start_time = time.perf_counter()
+        setup_time = time.perf_counter()
+        async with mcp_sessions.acquire(db_name) as mcp:
+            tools = mcp.tools + [get_schema_tool(db_name)]
+            #web_search_tool = {"type": "web_search_preview"}
+            #all_tools = tools + [web_search_tool]
+
+            #model = model.bind_tools(web_search_tool)
+
+            if request is None:
+                request = await prepare_request(prompt, session_id, db_name)
+            agent_prompt = request["agent_prompt"]
+            from langgraph.prebuilt import create_react_agent
+            agent = agent_cache.get_or_create(
+                db_name, request["system_prompt"], tools,
+                lambda: create_react_agent(model, tools, prompt=agent_prompt)
+            )
+            combined_prompt = request["system_prompt"] + request["context"] + prompt
+            messages = request["messages"]
+            logger.info(f"(API) Estimated tokens for request: {request['estimated_tokens']}")
+
+            response_parts = []
+            input_tokens = None
+            output_tokens = None
+            total_tokens = None
+            cached_tokens = None
+            tool_name = None
+            tools_used = set()
+
+            finish_setup = time.perf_counter() - setup_time
+            logger.info(f'(API) Pre Streaming Setup Time: {finish_setup}')
+            logger.info(f"(API) MCP setup time saved so far: {mcp_sessions.stats['setup_time_saved']:.3f}s")
+
+            stream_time_start = time.perf_counter()
+
+            async def deltas():
+                nonlocal input_tokens, output_tokens, total_tokens, cached_tokens, tool_name, consumed_tokens
+                async for event in agent.astream_events({"messages": messages}, version="v2"):
                     if event["event"] == "on_chat_model_stream":
                         chunk = event["data"]["chunk"]
                         usage = getattr(chunk, "usage_metadata", None)
                         if usage:
-                            input_tokens = usage.get("input_tokens")
-                            output_tokens = usage.get("output_tokens")
-                            total_tokens = usage.get("total_tokens")
+                            # Summed over every model call of the react loop
+                            input_tokens = (input_tokens or 0) + (usage.get("input_tokens") or 0)
+                            output_tokens = (output_tokens or 0) + (usage.get("output_tokens") or 0)
+                            total_tokens = (total_tokens or 0) + (usage.get("total_tokens") or 0)
+                            cached_tokens = (cached_tokens or 0) + (usage.get("input_token_details", {}).get("cache_read") or 0)
+                            consumed_tokens += usage.get("total_tokens") or 0
                         if hasattr(chunk, "content") and chunk.content:
-                            full_response += chunk.content
-                            yield f"data: {chunk.content}\n\n"
+                            response_parts.append(chunk.content)
+                            yield chunk.content
                     elif event["event"] == "on_tool_start":
                         tool_name = event["name"]
-                        logger.info(f"Tool Used: {tool_name}") 
-
-                stream_time_end = time.perf_counter() - stream_time_start
-                logger.info(f"Streaming time elapsed: {stream_time_end}")
-
-                logger.log_on_chat_end(
-                    history, combined_prompt, full_response, start_time, input_tokens, output_tokens, total_tokens, model, tool_name
-                )
-                yield f"event: end\ndata: {json.dumps({'message': 'stream complete'})}\n\n"
-                logger.info("[END] Process Finished")
+                        tools_used.add(tool_name)
+                        logger.info(f"Tool Used: {tool_name}")
+
+            # Tokens are batched into fewer frames, with keep-alives while tools run
+            async for frame in coalesce_sse(deltas()):
+                yield frame
+            full_response = "".join(response_parts)
+
+            stream_time_end = time.perf_counter() - stream_time_start
+            logger.info(f"Streaming time elapsed: {stream_time_end}")
+
+            # Only queues the writes, so the end frame is not held back by the database
+            if input_tokens:
+                logger.info(f"(API) Prompt cache: {cached_tokens} of {input_tokens} input tokens cached")
+            logger.log_on_chat_end(
+                session_id, prompt, combined_prompt, full_response, start_time, input_tokens, output_tokens, total_tokens, model,
+                tool_name, cached_tokens
+            )
+            yield f"event: end\ndata: {json.dumps({'message': 'stream complete'})}\n\n"
+            logger.info("[END] Process Finished")
+
+            if settings.ANSWER_CACHE_ENABLED and request["cacheable"]:
+                await answer_cache.store(prompt, db_name, request["schema_fingerprint"], full_response, tools_used)
 
     except Exception as e:
         logger.error(f"run_agent error: {traceback.format_exc()}")
@@ -96,8 +164,13 @@ async def run_agent(prompt: str, session_id: str = "default", db_name: str = set
             yield f"event: error\ndata: {json.dumps({'message': message})}\n\n"
         else:
             yield f"event: error\ndata: {json.dumps({'message': 'It seems there was an error. Please try again later.'})}\n\n"
+    finally:
+        # Settle the admission reservation against what the model actually reported
+        if on_usage is not None:
+            on_usage(consumed_tokens)
 
 def find_ratelimit_error(exc):
+    import openai
     while exc:
         if isinstance(exc, openai.RateLimitError):
             return exc
@@ -106,41 +179,49 @@ def find_ratelimit_error(exc):
 
 
 
-def create_prompt(db_name: str, file_context: dict = None):
-    """Format and update the agent prompt with table schema and file content"""
-    with UserRepository(dbname=db_name) as repo:
-        schema_info = repo.get_tables_info()
+async def create_prompt(db_name: str, file_context: dict = None, prompt: str = ""):
+    """Build the agent prompt and the per-question context for a request.
+
+    Returns (agent_prompt, system_prompt, context). The system prompt is the template plus
+    the schema and is byte-identical for every question against db_name, so OpenAI can serve
+    it from its prompt cache; relevant table details and file content go in `context`,
+    which prepare_request sends as a system message after the history.
+    """
+    schema_prefix, relevant_schema = await get_prompt_schema(db_name, prompt)
 
-    formatted_sql_prompt = sql_generation_template.format(
+    system_prompt = sql_generation_template.format(
         dialect=settings.DIALECT,
         top_k=settings.TOP_K,
-        tables_info=schema_info,
+        tables_info=schema_prefix,
         export_k=settings.EXPORT_TOP_K,
         newline=settings.NEWLINE_CHAR,
     )
-    combined_prompt = formatted_sql_prompt
-    if file_context:
-        if isinstance(file_context['data'], list):
-        # Convert list of dicts to a CSV-like string
-            formatted_data = json.dumps(file_context['data'], indent=2)
-        elif isinstance(file_context['data'], str):
-            # Already a string, like from a .txt file
-            formatted_data = file_context['data']
-        else:
-            # Fallback for unexpected data types
-            formatted_data = json.dumps(file_context['data'], indent=2)
-
-        # Escape braces for prompt injection safety
-        escaped_content = formatted_data.replace("{", "{{").replace("}", "}}")
-        
-        combined_prompt += '\n\nAdditional file context provided by user:\n'
-        combined_prompt += f'File Name: {file_context["filename"]}\n' 
-        escaped_content = file_context['data'].replace("{", "{{").replace("}", "}}")
-        combined_prompt += f'File Content: \n\n{escaped_content}'
 
+    context_parts = []
+    if relevant_schema:
+        context_parts.append(f"Columns of the tables most relevant to this question:\n{relevant_schema}")
+    if file_context:
+        # Table summary or the most relevant text chunks, within FILE_CONTEXT_TOKEN_BUDGET.
+        # Indexed uploads are searched by embedding; the rest use lexical selection
+        formatted_data = None
+        if file_context.get("chunk_count"):
+            formatted_data = await search_upload(file_context["id"], prompt)
+        if formatted_data is None:
+            formatted_data = await asyncio.to_thread(build_file_context, file_context, prompt)
+
+        context_parts.append(
+            'Additional file context provided by user:\n'
+            f'File Name: {file_context["filename"]}\n'
+            f'File Content: \n\n{formatted_data}'
+        )
+
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    # A message object rather than a template string, so braces in the schema are never treated as variables
     agent_prompt = ChatPromptTemplate.from_messages([
-        ("system", combined_prompt),
+        SystemMessage(content=system_prompt),
         MessagesPlaceholder(variable_name="messages")
     ])
 
-    return agent_prompt, combined_prompt
+    return agent_prompt, system_prompt, "\n\n".join(context_parts)
+
@@ -1,41 +1,64 @@
 import uuid
-import psycopg
-from langchain_postgres import PostgresChatMessageHistory
-from settings import Settings
-from langchain_core.chat_history import BaseChatMessageHistory
-from llm_logger import LLMLogger
+import threading
+from collections import OrderedDict, deque
+from psycopg import sql
+from settings import get_settings
+from langchain_core.messages import BaseMessage, messages_from_dict
+from llm_logger import get_logger
+from db_pool import get_async_connection
 
-settings = Settings()
+settings = get_settings()
 
-logger = LLMLogger()
+logger = get_logger()
 
+# session_id -> the most recent MEMORY_LIMIT messages, in order; bounded LRU over sessions.
+# Opt-in (HISTORY_CACHE_SIZE > 0): it assumes a session's turns are served by this process, as a
+# message written by another worker is only seen after the entry is evicted. Only enable it with
+# a single worker or session-sticky routing.
+_recent_messages: OrderedDict[str, deque] = OrderedDict()
+_recent_messages_lock = threading.Lock()
 
-def get_psycopg_conn():
-    return psycopg.connect(
-        host=settings.DB_HOST,
-        port=settings.DB_PORT,
-        user=settings.DB_USER,
-        password=settings.DB_PASSWORD,
-        dbname=settings.DB_NAME,
-    )
-
-def ensure_chat_history_table_exists():
-    conn = get_psycopg_conn()
-    try:
-        PostgresChatMessageHistory.create_tables(conn, settings.DB_CHAT_HISTORY_TABLE)
-        logger.info(f"(API) Ensured chat history table '{settings.DB_CHAT_HISTORY_TABLE}' exists.")
-    finally:
-        conn.close()
 
 # Function to generate a session ID
 def generate_session_id() -> str:
     return str(uuid.uuid4())
 
-# Returns a ChatMessageHistory object tied to a session
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    logger.info("(API) Getting Session History")
-    return PostgresChatMessageHistory(
-        settings.DB_CHAT_HISTORY_TABLE,
-        session_id,
-        sync_connection=get_psycopg_conn()
-    )
\ No newline at end of file
+async def get_recent_messages(session_id: str, limit: int = settings.MEMORY_LIMIT) -> list[BaseMessage]:
+    """Last `limit` messages of a session, served from memory after the first read"""
+    with _recent_messages_lock:
+        cached = _recent_messages.get(session_id)
+        if cached is not None:
+            _recent_messages.move_to_end(session_id)
+            return list(cached)[-limit:]
+
+    logger.info("(API) Loading recent session history")
+    query = sql.SQL("SELECT message FROM {table} WHERE session_id = %s ORDER BY id DESC LIMIT %s").format(
+        table=sql.Identifier(settings.DB_CHAT_HISTORY_TABLE)
+    )
+    async with get_async_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, (session_id, limit))
+            rows = await cur.fetchall()
+    messages = messages_from_dict([row[0] for row in reversed(rows)])
+
+    if settings.HISTORY_CACHE_SIZE > 0:
+        with _recent_messages_lock:
+            _recent_messages[session_id] = deque(messages, maxlen=settings.MEMORY_LIMIT)
+            _recent_messages.move_to_end(session_id)
+            while len(_recent_messages) > settings.HISTORY_CACHE_SIZE:
+                _recent_messages.popitem(last=False)
+    return messages
+
+
+def remember_messages(session_id: str, messages: list[BaseMessage]):
+    """Append messages the chat writer has persisted to the session's cached history, if it is cached"""
+    with _recent_messages_lock:
+        cached = _recent_messages.get(session_id)
+        if cached is not None:
+            cached.extend(messages)
+
+
+def forget_messages(session_id: str):
+    """Drop a session's cached history, e.g. after its messages failed to persist, so the next read goes to the database"""
+    with _recent_messages_lock:
+        _recent_messages.pop(session_id, None)
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from settings import get_settings
+
+settings = get_settings()
+
+# One pool per target database, shared for the lifetime of the process
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+# Async pools serve the request path so Postgres calls never block the event loop
+_async_pools: dict[str, AsyncConnectionPool] = {}
+_async_pools_lock = asyncio.Lock()
+# database_name values of available_databases; only these (and DB_NAME) get pools, so a
+# client-supplied db_name cannot open connections to arbitrary databases
+_known_databases = {"names": frozenset(), "loaded_at": 0.0}
+
+
+def _conninfo(db_name: str) -> str:
+    return make_conninfo(
+        host=settings.DB_HOST,
+        port=settings.DB_PORT,
+        user=settings.DB_USER,
+        password=settings.DB_PASSWORD,
+        dbname=db_name,
+    )
+
+
+async def is_known_database(db_name: str) -> bool:
+    """True for DB_NAME and the databases listed in available_databases.
+
+    The list is re-read when an unknown name is asked for, at most every DATABASE_LIST_TTL seconds.
+    """
+    if db_name == settings.DB_NAME or db_name in _known_databases["names"]:
+        return True
+    if time.monotonic() - _known_databases["loaded_at"] > settings.DATABASE_LIST_TTL:
+        async with get_async_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT database_name FROM available_databases;")
+                rows = await cur.fetchall()
+        _known_databases.update(names=frozenset(row[0] for row in rows), loaded_at=time.monotonic())
+    return db_name in _known_databases["names"]
+
+
+def _check_known(db_name: str):
+    if db_name != settings.DB_NAME and db_name not in _known_databases["names"]:
+        raise LookupError(f"Unknown database '{db_name}'")
+
+
+def get_pool(db_name: str = settings.DB_NAME) -> ConnectionPool:
+    """Return the connection pool for db_name, creating it on first use"""
+    pool = _pools.get(db_name)
+    if pool is not None:
+        return pool
+    _check_known(db_name)
+
+    with _pools_lock:
+        pool = _pools.get(db_name)
+        if pool is None:
+            pool = ConnectionPool(
+                _conninfo(db_name),
+                min_size=settings.DB_POOL_MIN_SIZE,
+                max_size=settings.DB_POOL_MAX_SIZE,
+                timeout=settings.DB_POOL_TIMEOUT,
+                name=f"pool-{db_name}",
+                open=False,
+            )
+            pool.open()
+            _pools[db_name] = pool
+    return pool
+
+
+@contextmanager
+def get_connection(db_name: str = settings.DB_NAME):
+    """Borrow a connection from the pool; commits on success and rolls back on error"""
+    with get_pool(db_name).connection() as conn:
+        yield conn
+
+
+async def get_async_pool(db_name: str = settings.DB_NAME) -> AsyncConnectionPool:
+    """Return the async connection pool for db_name, creating it on first use; db_name must be known"""
+    pool = _async_pools.get(db_name)
+    if pool is not None:
+        return pool
+    if not await is_known_database(db_name):
+        raise LookupError(f"Unknown database '{db_name}'")
+
+    async with _async_pools_lock:
+        pool = _async_pools.get(db_name)
+        if pool is None:
+            pool = AsyncConnectionPool(
+                _conninfo(db_name),
+                min_size=settings.DB_POOL_MIN_SIZE,
+                max_size=settings.DB_POOL_MAX_SIZE,
+                timeout=settings.DB_POOL_TIMEOUT,
+                name=f"async-pool-{db_name}",
+                open=False,
+            )
+            await pool.open()
+            _async_pools[db_name] = pool
+    return pool
+
+
+@asynccontextmanager
+async def get_async_connection(db_name: str = settings.DB_NAME):
+    """Borrow an async connection from the pool; commits on success and rolls back on error"""
+    pool = await get_async_pool(db_name)
+    async with pool.connection() as conn:
+        yield conn
+
+
+async def open_pools():
+    """Open the main database pools and wait until min_size connections are ready"""
+    get_pool(settings.DB_NAME).wait(timeout=settings.DB_POOL_TIMEOUT)
+    pool = await get_async_pool(settings.DB_NAME)
+    await pool.wait(timeout=settings.DB_POOL_TIMEOUT)
+
+
+async def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+    async_pools = list(_async_pools.values())
+    _async_pools.clear()
+    for async_pool in async_pools:
+        await async_pool.close()
+
+
+def pool_stats() -> dict:
+    return {
+        "sync": {db_name: pool.get_stats() for db_name, pool in list(_pools.items())},
+        "async": {db_name: pool.get_stats() for db_name, pool in list(_async_pools.items())},
+    }
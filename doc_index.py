@@ -0,0 +1,107 @@
+import time
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_connection
+from embeddings import get_embedder, to_vector_literal
+from token_counter import count_tokens
+
+settings = get_settings()
+logger = get_logger()
+
+_stats = {"indexed_uploads": 0, "indexed_chunks": 0, "index_failures": 0, "searches": 0, "search_failures": 0}
+
+
+def chunk_text(text: str) -> list[str]:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.FILE_CONTEXT_CHUNK_SIZE,
+        chunk_overlap=settings.FILE_CONTEXT_CHUNK_OVERLAP,
+    )
+    return splitter.split_text(text)
+
+
+async def embed_upload(text: str) -> list[tuple]:
+    """Chunk and embed a text upload; returns (chunk_index, content, token_count, vector) rows.
+
+    Uploads that already fit FILE_CONTEXT_TOKEN_BUDGET are sent whole, so they are not indexed.
+    Embedding failures are logged and leave the upload unindexed; it then falls back to
+    lexical chunk selection in file_context.
+    """
+    if count_tokens(text) <= settings.FILE_CONTEXT_TOKEN_BUDGET:
+        return []
+
+    start_time = time.perf_counter()
+    try:
+        chunks = chunk_text(text)
+        vectors = await get_embedder().embed_documents(chunks)
+    except Exception as e:
+        _stats["index_failures"] += 1
+        logger.error(f"(API) Failed to embed upload chunks: {e}")
+        return []
+
+    logger.info(f"(API) Embedded {len(chunks)} upload chunks in {time.perf_counter() - start_time:.3f}s")
+    return [
+        (index, chunk, count_tokens(chunk), to_vector_literal(vector))
+        for index, (chunk, vector) in enumerate(zip(chunks, vectors))
+    ]
+
+
+async def insert_upload_chunks(cur, upload_id: int, session_id: str, rows: list[tuple]):
+    """Store embedded chunks on the caller's cursor, in the same transaction as the upload row"""
+    await cur.executemany("""
+        INSERT INTO upload_chunks (upload_id, session_id, chunk_index, content, token_count, embedding)
+        VALUES (%s, %s, %s, %s, %s, %s::vector);
+    """, [(upload_id, session_id, *row) for row in rows])
+    _stats["indexed_uploads"] += 1
+    _stats["indexed_chunks"] += len(rows)
+
+
+async def copy_upload_chunks(cur, source_upload_id: int, upload_id: int, session_id: str):
+    """Reuse the embedded chunks of an identical earlier upload instead of embedding again"""
+    await cur.execute("""
+        INSERT INTO upload_chunks (upload_id, session_id, chunk_index, content, token_count, embedding)
+        SELECT %s, %s, chunk_index, content, token_count, embedding
+        FROM upload_chunks WHERE upload_id = %s;
+    """, (upload_id, session_id, source_upload_id))
+
+
+async def search_upload(upload_id: int, query: str, token_budget: int = settings.FILE_CONTEXT_TOKEN_BUDGET):
+    """The top FILE_RETRIEVAL_TOP_K chunks nearest to the query that fit token_budget, in document order.
+
+    Returns None when the index cannot be used, so the caller can fall back to lexical selection.
+    """
+    _stats["searches"] += 1
+    try:
+        vector = to_vector_literal(await get_embedder().embed_query(query))
+        async with get_async_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    SELECT chunk_index, content, token_count
+                    FROM upload_chunks
+                    WHERE upload_id = %s
+                    ORDER BY embedding <=> %s::vector
+                    LIMIT %s;
+                """, (upload_id, vector, settings.FILE_RETRIEVAL_TOP_K))
+                rows = await cur.fetchall()
+    except Exception as e:
+        _stats["search_failures"] += 1
+        logger.error(f"(API) Upload chunk search failed for upload {upload_id}: {e}")
+        return None
+
+    if not rows:
+        return None
+
+    selected = []
+    used = 0
+    for chunk_index, content, token_count in rows:
+        if used + token_count > token_budget:
+            continue
+        selected.append((chunk_index, content))
+        used += token_count
+    logger.info(f"(API) Retrieved {len(selected)} chunks ({used} tokens) for upload {upload_id}")
+    return "\n...\n".join(content for _, content in sorted(selected))
+
+
+def doc_index_stats() -> dict:
+    return dict(_stats)
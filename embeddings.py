@@ -0,0 +1,81 @@
+import re
+import math
+import asyncio
+from collections import Counter
+from functools import lru_cache
+
+import xxhash
+
+from settings import get_settings
+from llm_logger import get_logger
+
+settings = get_settings()
+logger = get_logger()
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """Deterministic feature-hashing embedder: no network, no model, same vector for the same text.
+
+    Words and word bigrams are hashed into `dim` signed buckets, weighted by 1 + log(tf) and
+    L2-normalised, so cosine distance behaves like a lexical similarity. Meant for offline
+    runs and tests; retrieval quality is that of keyword matching.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def _embed(self, text: str) -> list[float]:
+        import numpy as np
+        words = WORD_PATTERN.findall(text.lower())
+        features = Counter(words)
+        features.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in features.items():
+            digest = xxhash.xxh64_intdigest(feature)
+            sign = 1.0 if digest >> 63 else -1.0
+            vector[digest % self.dim] += sign * (1 + math.log(count))
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    async def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(lambda: [self._embed(text) for text in texts])
+
+    async def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+class OpenAIEmbedder:
+    """OpenAI embeddings, truncated server-side to `dim` dimensions so they fit the upload_chunks column"""
+
+    def __init__(self, model: str, dim: int, batch_size: int):
+        from langchain_openai import OpenAIEmbeddings
+
+        self.dim = dim
+        self.client = OpenAIEmbeddings(model=model, dimensions=dim, chunk_size=batch_size)
+
+    async def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.client.aembed_documents(texts)
+
+    async def embed_query(self, text: str) -> list[float]:
+        return await self.client.aembed_query(text)
+
+
+@lru_cache(maxsize=1)
+def get_embedder():
+    """The embedder selected by EMBEDDING_PROVIDER ('openai' or 'hashing')"""
+    if settings.EMBEDDING_PROVIDER == "hashing":
+        return HashingEmbedder(settings.EMBEDDING_DIM)
+    if settings.EMBEDDING_PROVIDER == "openai":
+        return OpenAIEmbedder(settings.EMBEDDING_MODEL, settings.EMBEDDING_DIM, settings.EMBEDDING_BATCH_SIZE)
+    raise ValueError(f"Unknown EMBEDDING_PROVIDER: {settings.EMBEDDING_PROVIDER}")
+
+
+def to_vector_literal(vector: list[float]) -> str:
+    """pgvector text format, so no per-connection type registration is needed"""
+    return "[" + ",".join(f"{value:.7g}" for value in vector) + "]"
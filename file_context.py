@@ -0,0 +1,144 @@
+import re
+import math
+import random
+import threading
+from collections import OrderedDict, Counter
+
+from settings import get_settings
+from llm_logger import get_logger
+from token_counter import count_tokens
+from file_upload import load_upload_data
+from doc_index import chunk_text
+
+settings = get_settings()
+logger = get_logger()
+
+WORD_PATTERN = re.compile(r"\w+")
+SAMPLE_ROW_STEP = 5
+
+# parsed blob hash (or upload id) -> prompt-independent work (table summary or text chunks), bounded LRU.
+# build_file_context runs in worker threads, so every access holds _cache_lock
+_cache: OrderedDict = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _get_cached(upload_id, build):
+    with _cache_lock:
+        if upload_id is not None and upload_id in _cache:
+            _stats["hits"] += 1
+            _cache.move_to_end(upload_id)
+            return _cache[upload_id]
+        _stats["misses"] += 1
+
+    # Built outside the lock; two threads missing on the same upload both build it
+    value = build()
+    if upload_id is not None:
+        with _cache_lock:
+            _cache[upload_id] = value
+            _cache.move_to_end(upload_id)
+            while len(_cache) > settings.FILE_CONTEXT_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return value
+
+
+def _load_data(file_context: dict):
+    # Runs in build_file_context's worker thread, only on a cache miss
+    return load_upload_data(file_context["id"], file_context["kind"])
+
+
+def _describe_column(frame, column) -> str:
+    series = frame[column]
+    line = f"  - {column} ({series.dtype}): {series.notna().sum()} non-null, {series.nunique()} unique"
+    if series.dtype.kind in "iuf" and series.notna().any():
+        line += f", min {series.min()}, max {series.max()}, mean {series.mean():.4g}"
+    else:
+        top_values = series.dropna().astype(str).value_counts().head(3)
+        if len(top_values):
+            line += ", top: " + ", ".join(f"{value!r} ({count})" for value, count in top_values.items())
+    return line
+
+
+def summarize_table(frame, token_budget: int) -> str:
+    """Schema, per-column statistics and as many sampled rows as fit in token_budget"""
+    header = f"Rows: {len(frame)}, Columns: {len(frame.columns)}\nColumns:\n"
+    summary = header
+    for column in frame.columns:
+        line = _describe_column(frame, column) + "\n"
+        if count_tokens(summary + line) > token_budget:
+            summary += "  - ... (more columns omitted)\n"
+            break
+        summary += line
+
+    # First rows, then an evenly spread sample of the rest, until the budget runs out
+    if len(frame) <= SAMPLE_ROW_STEP:
+        order = list(range(len(frame)))
+    else:
+        spread = list(range(SAMPLE_ROW_STEP, len(frame)))
+        random.Random(0).shuffle(spread)
+        order = list(range(SAMPLE_ROW_STEP)) + spread
+
+    sample_header = "Sample rows (CSV):\n"
+    remaining = token_budget - count_tokens(summary + sample_header)
+    selected = []
+    for start in range(0, len(order), SAMPLE_ROW_STEP):
+        candidate = sorted(selected + order[start:start + SAMPLE_ROW_STEP])
+        if count_tokens(frame.iloc[candidate].to_csv(index=False)) > remaining:
+            break
+        selected = candidate
+
+    if selected:
+        summary += sample_header + frame.iloc[selected].to_csv(index=False)
+    return summary
+
+
+def split_text(text: str) -> list[dict]:
+    return [
+        {"text": chunk, "tokens": count_tokens(chunk), "terms": Counter(WORD_PATTERN.findall(chunk.lower()))}
+        for chunk in chunk_text(text)
+    ]
+
+
+def select_chunks(chunks: list[dict], prompt: str, token_budget: int) -> list[str]:
+    """Most relevant chunks for the prompt (idf-weighted term overlap) that fit the budget, in document order"""
+    if sum(chunk["tokens"] for chunk in chunks) <= token_budget:
+        return [chunk["text"] for chunk in chunks]
+
+    query_terms = set(WORD_PATTERN.findall(prompt.lower()))
+    document_frequency = Counter(term for chunk in chunks for term in query_terms & chunk["terms"].keys())
+
+    def score(chunk):
+        return sum(
+            (1 + math.log(chunk["terms"][term])) * math.log(1 + len(chunks) / document_frequency[term])
+            for term in query_terms if chunk["terms"][term]
+        )
+
+    ranked = sorted(range(len(chunks)), key=lambda i: (-score(chunks[i]), i))
+    selected = []
+    used = 0
+    for i in ranked:
+        if used + chunks[i]["tokens"] > token_budget:
+            continue
+        selected.append(i)
+        used += chunks[i]["tokens"]
+    return [chunks[i]["text"] for i in sorted(selected)]
+
+
+def build_file_context(file_context: dict, prompt: str, token_budget: int = settings.FILE_CONTEXT_TOKEN_BUDGET) -> str:
+    """Render an upload for the system prompt within token_budget tokens"""
+    # Identical uploads share a blob hash, so they also share the summary work
+    upload_id = file_context.get("parsed_blob") or file_context.get("id")
+
+    if file_context["kind"] == "table":
+        return _get_cached(upload_id, lambda: summarize_table(_load_data(file_context), token_budget))
+
+    chunks = _get_cached(upload_id, lambda: split_text(str(_load_data(file_context))))
+    selected = select_chunks(chunks, prompt, token_budget)
+    if len(selected) < len(chunks):
+        logger.info(f"(API) Using {len(selected)} of {len(chunks)} file chunks for the prompt")
+    return "\n...\n".join(selected)
+
+
+def file_context_stats() -> dict:
+    with _cache_lock:
+        return {**_stats, "cached_uploads": len(_cache)}
@@ -0,0 +1,169 @@
+import re
+import zlib
+
+import zstandard
+from fastapi import HTTPException
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_connection
+
+settings = get_settings()
+logger = get_logger()
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+async def get_download_info(id: int) -> dict:
+    """Metadata of a modified file without reading its content"""
+    async with get_async_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT m.filename, m.file_type, coalesce(b.size, octet_length(m.content)), m.upload_time,
+                       m.content_blob, b.stored_size
+                FROM modified_files m
+                LEFT JOIN blobs b ON b.hash = m.content_blob
+                WHERE m.id = %s;
+            """, (id,))
+            result = await cur.fetchone()
+    if not result:
+        return None
+
+    filename, file_type, size, upload_time, blob, stored_size = result
+    if blob:
+        etag = f'"{blob}"'
+    else:
+        # Exported files are never rewritten in place, so id, size and time identify the content
+        version = int(upload_time.timestamp() * 1_000_000) if upload_time else 0
+        etag = f'"{id}-{size}-{version}"'
+    return {
+        "id": id,
+        "filename": filename,
+        "file_type": file_type,
+        "size": size,
+        "blob": blob,
+        "stored_size": stored_size,
+        "etag": etag,
+    }
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single `bytes=` range, None to serve the whole file.
+
+    Multi-range and malformed headers (including last-pos < first-pos) are ignored as RFC 9110
+    allows; unsatisfiable ranges raise 416.
+    """
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None or not any(match.groups()):
+        return None
+
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        return None
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Entity tag of one content-coding of a file; each encoding has different bytes, so its own strong tag"""
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match against etag: "*" or an exact match of one listed tag (weak comparison, W/ ignored)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == "*" or tag.removeprefix("W/") == etag for tag in tags)
+
+
+def choose_encoding(accept_encoding: str):
+    """zstd or gzip when the client accepts it and DOWNLOAD_COMPRESSION allows it"""
+    if not settings.DOWNLOAD_COMPRESSION or not accept_encoding:
+        return None
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    for encoding in ("zstd", "gzip"):
+        if encoding in accepted and encoding in settings.DOWNLOAD_COMPRESSION.split(","):
+            return encoding
+    return None
+
+
+async def _iter_slices(query: str, key, start: int, end: int):
+    """Yield bytes start..end (inclusive) of a BYTEA value in DOWNLOAD_CHUNK_SIZE slices.
+
+    Each slice borrows a pooled connection only for its own query, so slow clients do not
+    hold connections. The columns use EXTERNAL storage, so substring() reads only the slice.
+    Raises LookupError when the value disappears mid-way, so the response is aborted instead
+    of ending short.
+    """
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+    position = start
+    while position <= end:
+        length = min(chunk_size, end - position + 1)
+        async with get_async_connection() as conn:
+            async with conn.cursor() as cur:
+                # substring() positions are 1-based
+                await cur.execute(query, (position + 1, length, key))
+                row = await cur.fetchone()
+        if not row or row[0] is None:
+            raise LookupError(f"content of {key} is gone at byte {position}")
+        yield bytes(row[0])
+        position += length
+
+
+def iter_blob_compressed(record: dict):
+    """The stored zstd frame of a blob-backed file, unchanged"""
+    return _iter_slices("SELECT substring(data FROM %s FOR %s) FROM blobs WHERE hash = %s;",
+                        record["blob"], 0, record["stored_size"] - 1)
+
+
+async def iter_file_content(record: dict, start: int, end: int):
+    """Yield uncompressed bytes start..end (inclusive) of a modified file, inline or blob-backed"""
+    if not record["blob"]:
+        try:
+            async for chunk in _iter_slices("SELECT substring(content FROM %s FOR %s) FROM modified_files WHERE id = %s;",
+                                            record["id"], start, end):
+                yield chunk
+                start += len(chunk)
+            return
+        except LookupError:
+            # The blob migrator moved the content into blobs mid-download; continue from the blob
+            moved = await get_download_info(record["id"])
+            if moved is None or not moved["blob"]:
+                raise
+            logger.info(f"(API) File {record['id']} moved to blob {moved['blob']} during download, resuming at byte {start}")
+            record = moved
+
+    # Blobs are one zstd frame: decompress from the start, skipping to the requested range
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    position = 0
+    async for compressed in iter_blob_compressed(record):
+        chunk = decompressor.decompress(compressed)
+        chunk_start, position = position, position + len(chunk)
+        if position <= start:
+            continue
+        yield chunk[max(start - chunk_start, 0):end + 1 - chunk_start]
+        if position > end:
+            return
+
+
+async def compress_stream(chunks, encoding: str):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level=settings.DOWNLOAD_COMPRESSION_LEVEL, wbits=31)
+    else:
+        compressor = zstandard.ZstdCompressor(level=settings.DOWNLOAD_COMPRESSION_LEVEL).compressobj()
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
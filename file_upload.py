@@ -1,84 +1,256 @@
 from fastapi import UploadFile, HTTPException
-from settings import Settings
-from llm_logger import LLMLogger
+from fastapi.responses import JSONResponse
+from settings import get_settings
+from llm_logger import get_logger
+import asyncio
 import json
+import time
 from pathlib import Path
-import pandas as pd
-import io
-import PyPDF2
-from settings import Settings
-import psycopg2
+import zstandard
 from datetime import datetime
 from user_repository import UserRepository
+from db_pool import get_connection, get_async_connection
+from doc_index import embed_upload, insert_upload_chunks, copy_upload_chunks
+import blob_store
 
-import numpy as np
+settings = get_settings()
 
-settings = Settings()
+logger = get_logger()
 
-logger = LLMLogger()
+# Multipart boundaries and part headers sent around the file itself
+UPLOAD_FORM_OVERHEAD = 16384
 
-connection_params = {
-    "host": settings.DB_HOST,
-    "port": settings.DB_PORT,
-    "user": settings.DB_USER,
-    "password": settings.DB_PASSWORD,
-    "dbname": settings.DB_NAME,
-}
 
+class UploadSizeLimit:
+    """ASGI middleware answering 413 from Content-Length, before Starlette spools an oversized /upload body to disk.
+
+    Requests without Content-Length (chunked) are still checked while process_file reads the file.
+    """
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/upload":
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > self.max_size:
+                response = JSONResponse({"detail": "File too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _PayloadWriter:
+    """Hashes and zstd-compresses the parsed payload piece by piece, so it is never held whole"""
+
+    def __init__(self):
+        self.hasher = blob_store.new_hasher()
+        self.compressor = zstandard.ZstdCompressor(level=settings.UPLOAD_COMPRESSION_LEVEL).compressobj()
+        self.parts = []
+        self.size = 0
+
+    def write(self, text: str):
+        data = text.encode("utf-8")
+        self.size += len(data)
+        self.hasher.update(data)
+        self.parts.append(self.compressor.compress(data))
+
+    def finish(self) -> dict:
+        self.parts.append(self.compressor.flush())
+        return {"parsed_blob": self.hasher.hexdigest(), "payload_size": self.size, "parsed_content": b"".join(self.parts)}
+
+
+def _write_table(frames, writer: _PayloadWriter) -> int:
+    """Columnar JSON, one value array per column for each chunk of rows; returns the row count"""
+    rows = 0
+    for frame in frames:
+        if rows == 0 and not writer.size:
+            writer.write(
+                '{"columns": ' + json.dumps([str(col) for col in frame.columns])
+                + ', "dtypes": ' + json.dumps([str(dtype) for dtype in frame.dtypes]) + ', "chunks": ['
+            )
+        else:
+            writer.write(",")
+        writer.write("[" + ",".join(frame[col].to_json(orient="values", date_format="iso") for col in frame.columns) + "]")
+        rows += len(frame)
+    if not writer.size:
+        writer.write('{"columns": [], "dtypes": [], "chunks": [')
+    writer.write("]}")
+    return rows
+
+
+def parse_upload(stream, file_extension: str) -> dict:
+    """Parse an upload into the stored payload: columnar JSON for tabular files, UTF-8 text otherwise.
+
+    CSV files are read and serialised UPLOAD_CSV_CHUNK_ROWS rows at a time, so no whole DataFrame
+    is built. "data" is the text for text uploads (to embed it) and None for tables.
+    """
+    # pandas and PyPDF2 are imported on first use; most requests never parse a file
+    writer = _PayloadWriter()
+    if file_extension in (".csv", ".xlsx", ".xls"):
+        import pandas as pd
+        if file_extension == ".csv":
+            frames = pd.read_csv(stream, chunksize=settings.UPLOAD_CSV_CHUNK_ROWS)
+        else:
+            frames = [pd.read_excel(stream)]
+        rows = _write_table(frames, writer)
+        return {"kind": "table", "data": None, "rows": rows, **writer.finish()}
+
+    if file_extension == ".pdf":
+        import PyPDF2
+        reader = PyPDF2.PdfReader(stream)
+        pages = [page.extract_text() or "" for page in reader.pages]
+        text, rows = "\n\n".join(pages), len(pages)
+    else:
+        text = stream.read().decode("utf-8", errors="replace")
+        rows = text.count("\n") + 1
+    writer.write(text)
+    return {"kind": "text", "data": text, "rows": rows, **writer.finish()}
+
+
+def decode_parsed(kind: str, content: bytes):
+    """Inverse of parse_upload's payload for a zstd-compressed blob"""
+    payload = blob_store.decompress(content)
+    if kind == "table":
+        import pandas as pd
+        columnar = json.loads(payload)
+        columns = columnar["columns"]
+        # Uploads stored before chunked parsing hold a single "values" chunk
+        chunks = columnar["chunks"] if "chunks" in columnar else [columnar["values"]]
+        frames = [pd.DataFrame(dict(zip(columns, values)), columns=columns) for values in chunks]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    return payload.decode("utf-8")
+
+
+def load_upload_data(upload_id: int, kind: str):
+    """Parsed content of an upload, read and decoded only when file_context has no cached rendering of it"""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT coalesce(b.data, u.parsed_content), u.data
+                FROM uploaded_files u LEFT JOIN blobs b ON b.hash = u.parsed_blob
+                WHERE u.id = %s;
+            """, (upload_id,))
+            row = cur.fetchone()
+    if row is None:
+        raise LookupError(f"Upload {upload_id} no longer exists")
+    parsed_content, data = row
+    if parsed_content is not None:
+        return decode_parsed(kind, parsed_content)
+    # JSON data of uploads stored before parsed_content
+    return data
+
+
+async def _find_parsed_upload(cur, raw_blob: str, file_type: str):
+    """An earlier upload of the same bytes and file type, whose parse and chunk embeddings can be reused.
+
+    The extension decides how the bytes are parsed, so a .csv and a .txt of the same content do not match.
+    """
+    await cur.execute("""
+        SELECT id, parsed_blob, content_kind, row_count, chunk_count
+        FROM uploaded_files
+        WHERE raw_blob = %s AND file_type = %s AND parsed_blob IS NOT NULL
+        ORDER BY id DESC LIMIT 1;
+    """, (raw_blob, file_type))
+    return await cur.fetchone()
 
 
 async def process_file(file: UploadFile, session_id: str) -> dict:
     filename = file.filename
     file_extension = Path(filename).suffix.lower()
-    
-    content = await file.read()
+    start_time = time.perf_counter()
 
-    if len(content) > settings.MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large")
-    
-    processed_data = content.decode('utf-8')
+    # Starlette has already spooled the body to UploadFile.file (oversized requests are refused on
+    # Content-Length by UploadSizeLimit); hash and compress the raw bytes from there, then parse it in place
+    compressor = zstandard.ZstdCompressor(level=settings.UPLOAD_COMPRESSION_LEVEL).compressobj()
+    hasher = blob_store.new_hasher()
+    raw_parts = []
+    byte_size = 0
+    while chunk := await file.read(settings.UPLOAD_CHUNK_SIZE):
+        byte_size += len(chunk)
+        if byte_size > settings.MAX_FILE_SIZE:
+            raise HTTPException(status_code=413, detail="File too large")
+        hasher.update(chunk)
+        raw_parts.append(compressor.compress(chunk))
+    raw_parts.append(compressor.flush())
+    raw_blob = hasher.hexdigest()
+    await file.seek(0)
 
-    with psycopg2.connect(**connection_params) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO uploaded_files (session_id, filename, file_type, data, upload_time)
-                VALUES (%s, %s, %s, %s, %s);
+    async with get_async_connection() as conn:
+        async with conn.cursor() as cur:
+            previous = await _find_parsed_upload(cur, raw_blob, file_extension)
+
+    if previous is not None:
+        # Same bytes uploaded before: skip parsing and embedding entirely
+        previous_id, parsed_blob, kind, rows, chunk_count = previous
+        logger.info(f"(API) {filename} matches upload {previous_id}, reusing its parsed content")
+    else:
+        try:
+            parsed = await asyncio.to_thread(parse_upload, file.file, file_extension)
+        except ImportError as e:
+            raise HTTPException(status_code=415, detail=f"Unsupported file type {file_extension}: {e}")
+        kind, rows, parsed_blob = parsed["kind"], parsed["rows"], parsed["parsed_blob"]
+        chunk_count = None
+
+    parse_time = time.perf_counter() - start_time
+    logger.info(f"(API) Parsed {filename}: {rows} rows, {byte_size} bytes in {parse_time:.3f}s")
+
+    # Embed large text uploads now so each query only sends its top-k chunks
+    chunk_rows = []
+    if previous is None and kind == "text":
+        chunk_rows = await embed_upload(parsed["data"])
+        chunk_count = len(chunk_rows) or None
+
+    async with get_async_connection() as conn:
+        async with conn.cursor() as cur:
+            # Content lives in the deduplicated blob store; the row only references it
+            await blob_store.put_blob(cur, raw_blob, byte_size, b"".join(raw_parts))
+            if previous is None:
+                await blob_store.put_blob(cur, parsed_blob, parsed["payload_size"], parsed["parsed_content"])
+            else:
+                # The earlier upload keeps its parsed blob and chunks alive until this row commits
+                await cur.execute("SELECT 1 FROM uploaded_files WHERE id = %s FOR KEY SHARE;", (previous_id,))
+                if await cur.fetchone() is None:
+                    raise HTTPException(status_code=409, detail="The matching earlier upload was just cleaned up, please retry")
+            await cur.execute("""
+                INSERT INTO uploaded_files (session_id, filename, file_type, content_kind, raw_blob, parsed_blob, row_count, byte_size, chunk_count, upload_time)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id;
             """, (
                 session_id,
                 filename,
                 file_extension,
-                json.dumps(processed_data),
+                kind,
+                raw_blob,
+                parsed_blob,
+                rows,
+                byte_size,
+                chunk_count,
                 datetime.now()
             ))
+            upload_id = (await cur.fetchone())[0]
+            if chunk_rows:
+                await insert_upload_chunks(cur, upload_id, session_id, chunk_rows)
+            elif previous is not None and chunk_count:
+                await copy_upload_chunks(cur, previous_id, upload_id, session_id)
     
     return {
         "message": "File uploaded and processed successfully",
         "session_id": session_id,
         "file_type": file_extension,
-        "filename": filename
+        "filename": filename,
+        "rows": rows,
+        "bytes": byte_size,
+        "parse_time": parse_time,
+        "chunks": chunk_count or 0,
+        "deduplicated": previous is not None,
     }
 
-def get_uploaded_data(session_id: str) -> dict:
-    with UserRepository() as repo:
-        file_dict = repo.get_uploaded_data(session_id)
+async def get_uploaded_data(session_id: str) -> dict:
+    # Metadata only; file_context loads the content on a cache miss and indexed uploads are searched instead
+    async with UserRepository() as repo:
+        file_dict = await repo.get_uploaded_data(session_id)
         return file_dict
-
-def get_file_from_temp_table(id: int):
-    query = """
-        SELECT filename, file_type, content
-        FROM modified_files
-        WHERE id = %s
-    """
-    params = [id]
-
-    with psycopg2.connect(**connection_params) as conn:
-        with conn.cursor() as cur:
-            cur.execute(query, tuple(params))
-            result = cur.fetchone()
-            if not result:
-                return None
-            return {
-                "filename": result[0],
-                "file_type": result[1],
-                "content": result[2]
-            }
\ No newline at end of file
@@ -1,17 +1,18 @@
 import logging
-import psycopg2
-from datetime import datetime, timezone
-from settings import Settings
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from settings import get_settings
 from postgres_logging import PostgresHandler
 from langchain_core.messages import HumanMessage, AIMessage 
 import time
-from langchain_openai import ChatOpenAI
-from langchain_core.chat_history import BaseChatMessageHistory
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
 
 class LLMLogger:
     def __init__(self):
-        self.settings = Settings()
+        self.settings = get_settings()
 
         self.logger = logging.getLogger("llm_logger")
         log_level = getattr(logging, self.settings.LOG_LEVEL.upper(), logging.INFO)
@@ -26,11 +27,30 @@ class LLMLogger:
         }
 
         if self.settings.ENABLE_LOGGING and not self.logger.handlers:
-            pg_handler = PostgresHandler(self.connection_params)
+            pg_handler = PostgresHandler(
+                self.connection_params,
+                batch_size=self.settings.LOG_BATCH_SIZE,
+                flush_interval=self.settings.LOG_FLUSH_INTERVAL,
+                max_queue_size=self.settings.LOG_QUEUE_SIZE,
+            )
             pg_handler.setLevel(log_level)
             self.logger.addHandler(pg_handler)    
 
 
+    def handler_stats(self) -> dict:
+        return {
+            type(handler).__name__: handler.stats()
+            for handler in self.logger.handlers
+            if isinstance(handler, PostgresHandler)
+        }
+
+    def close(self):
+        """Flush and detach the database log handler"""
+        for handler in list(self.logger.handlers):
+            if isinstance(handler, PostgresHandler):
+                self.logger.removeHandler(handler)
+                handler.close()
+
     def info(self, message: str):
         self.logger.info(message, stacklevel=2)
 
@@ -41,27 +61,11 @@ class LLMLogger:
         self.logger.error(message, stacklevel=2)
 
     
-    def log_llm_use(self, model_name: str, prompt: str, response: str, input_tokens: int, output_tokens: int, total_tokens: int, tool_name: str = None):
-        try:
-            conn = psycopg2.connect(**self.connection_params)
-            with conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        INSERT INTO llm_logs (timestamp, model_name, prompt, response, input_tokens, output_tokens, total_tokens, tool_name)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-                    """, (
-                        datetime.now(timezone.utc), model_name, prompt, response, input_tokens, output_tokens, total_tokens, tool_name
-                    ))
-            
-        except Exception as e:
-            self.logger.error(f"Failed to log to PostgreSQL: {e}", stacklevel=2)
-        finally:
-            if conn:
-                conn.close()
-
-    def log_on_chat_end(self, history: BaseChatMessageHistory, prompt: str, full_response, start_time, input_tokens, output_tokens, total_tokens, model: ChatOpenAI, tool_name=None):
-        history.add_message(HumanMessage(content=prompt))
-        history.add_message(AIMessage(content=full_response))
+    def log_on_chat_end(self, session_id: str, user_prompt: str, prompt: str, full_response, start_time, input_tokens, output_tokens, total_tokens, model: "ChatOpenAI", tool_name=None, cached_tokens=None, cache_hit=False):
+        from chat_writer import chat_writer
+
+        # History keeps only the user's question; the full prompt sent to the model goes to llm_logs
+        messages = [HumanMessage(content=user_prompt), AIMessage(content=full_response)]
 
         self.info(f"Full Response: {full_response}")
         elapsed_time = time.perf_counter() - start_time
@@ -70,18 +74,27 @@ class LLMLogger:
         token_usage = {
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
-            "total_tokens": total_tokens
+            "total_tokens": total_tokens,
+            "cached_tokens": cached_tokens,
         }
 
         self.info(f"Token Usage: {token_usage}")
-        self.log_llm_use(
+        # History and llm_logs rows are written in batches by the write-behind worker
+        chat_writer.submit(
+            session_id,
+            messages,
             model.model_name,
             prompt,
             full_response,
             token_usage.get("input_tokens"),
             token_usage.get("output_tokens"),
             token_usage.get("total_tokens"),
-            tool_name
+            tool_name,
+            token_usage.get("cached_tokens"),
+            cache_hit,
         )
 
-    
+
+@lru_cache(maxsize=1)
+def get_logger() -> LLMLogger:
+    return LLMLogger()
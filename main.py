@@ -1,30 +1,90 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse
-from client import run_agent
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import StreamingResponse, Response
+from client import run_agent, prepare_request, get_model, warm_up
 from fastapi.middleware.cors import CORSMiddleware
-from settings import Settings
+from settings import get_settings
 from db_memory import generate_session_id
-from llm_logger import LLMLogger
-import uvicorn
-from file_upload import process_file, get_file_from_temp_table
-import io
+from llm_logger import get_logger
+from file_upload import process_file, UploadSizeLimit, UPLOAD_FORM_OVERHEAD
+from file_download import get_download_info, parse_range, choose_encoding, encoded_etag, etag_matches, iter_file_content, iter_blob_compressed, compress_stream
+from blob_store import migrate_to_blobs, storage_report, run_blob_migrator, blob_store_stats
+from maintenance import run_maintenance, run_maintenance_once, maintenance_stats
+import asyncio
+import json
 from TokenTracker import TokenUsageTracker
+from token_budget import PostgresTokenBudget
+from admission import AdmissionQueue
 from user_repository import UserRepository
-from main_db import create_tables
+from main_db import run_migrations, migration_stats
+from db_pool import open_pools, close_pools, pool_stats, is_known_database
+from schema_cache import invalidate_schema_cache, schema_cache_stats
+from mcp_sessions import mcp_sessions
+from agent_cache import agent_cache
+from chat_writer import chat_writer
+from file_context import file_context_stats
+from doc_index import doc_index_stats
+from answer_cache import answer_cache, replay_answer
+from tool_cache import tool_cache
+import time
+from contextlib import asynccontextmanager
 
 
-app = FastAPI()
+settings = get_settings()
 
+logger = get_logger()
 
-settings = Settings()
 
-logger = LLMLogger()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_pools()
+    run_migrations()
+    chat_writer.start()
+    get_model()
+    # Heavy imports for the first /query load in the background instead of on import
+    warm = asyncio.create_task(asyncio.to_thread(warm_up), name="warm-up")
+    blob_migrator = asyncio.create_task(run_blob_migrator(), name="blob-migrator")
+    maintenance = asyncio.create_task(run_maintenance(), name="maintenance")
+    lease_reaper = asyncio.create_task(token_tracker.backend.run_reaper(), name="lease-reaper") if token_tracker.backend else None
+    logger.info('Starting API')
+    yield
+    logger.info('Stopping API')
+    blob_migrator.cancel()
+    maintenance.cancel()
+    warm.cancel()
+    if lease_reaper is not None:
+        lease_reaper.cancel()
+    await mcp_sessions.close_all()
+    await chat_writer.close()
+    token_tracker.close()
+    logger.close()
+    await close_pools()
 
-create_tables()
 
-logger.info('Starting API')
+app = FastAPI(lifespan=lifespan)
 
-token_tracker = TokenUsageTracker(limit_per_minute=400000)
+token_tracker = TokenUsageTracker(
+    limit_per_minute=settings.TOKEN_LIMIT_PER_MINUTE,
+    requests_per_minute=settings.REQUEST_LIMIT_PER_MINUTE,
+    session_limit_per_minute=settings.SESSION_TOKEN_LIMIT_PER_MINUTE,
+    db_limit_per_minute=settings.DB_TOKEN_LIMIT_PER_MINUTE,
+    backend=PostgresTokenBudget(
+        "openai_tpm",
+        limit_per_minute=settings.TOKEN_LIMIT_PER_MINUTE,
+        lease_size=settings.TOKEN_LEASE_SIZE,
+        lease_ttl=settings.TOKEN_LEASE_TTL,
+        lease_requests=settings.TOKEN_LEASE_REQUESTS,
+    ) if settings.TOKEN_BACKEND == "postgres" else None,
+)
+
+admission_queue = AdmissionQueue(
+    token_tracker,
+    max_depth=settings.ADMISSION_MAX_QUEUE_DEPTH,
+    max_wait=settings.ADMISSION_MAX_WAIT,
+    poll_interval=settings.ADMISSION_POLL_INTERVAL,
+    position_interval=settings.ADMISSION_POSITION_INTERVAL,
+)
+
+app.add_middleware(UploadSizeLimit, max_size=settings.MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD)
 
 # Allow requests from React frontend
 app.add_middleware(
@@ -37,20 +97,62 @@ app.add_middleware(
 
 
 @app.get("/query")
-async def query(prompt: str, session_id: str, db_name: str):
+async def query(prompt: str, session_id: str, db_name: str, priority: int = 0):
     logger.info(f"(API) /query endpoint hit | Session: {session_id}")
-    with UserRepository() as repo:
-        estimated_tokens_needed = repo.estimate_tokens()
+    # Pools and MCP sessions are created per db_name, so only databases listed in available_databases are served
+    if not await is_known_database(db_name):
+        raise HTTPException(status_code=404, detail=f"Unknown database '{db_name}'")
+    try:
+        request = await prepare_request(prompt, session_id, db_name)
+        estimated_tokens_needed = request["estimated_tokens"]
+    except Exception as e:
+        # run_agent will retry the preparation and stream the error to the client
+        logger.error(f"(API) Failed to prepare request: {e}")
+        request = None
+        estimated_tokens_needed = settings.TOKEN_ESTIMATE_FALLBACK
 
-    if not token_tracker.can_process(estimated_tokens_needed):
-        logger.error("(API) Token limit exceeded. Request denied.")
-        async def error_stream():
-            yield f"RATE_LIMIT_ERROR: Too many requests are being processed, please wait 30 seconds.\n\n"
-        return StreamingResponse(error_stream(), media_type="text/event-stream")
+    if admission_queue.too_large(estimated_tokens_needed):
+        logger.error(f"(API) Request of {estimated_tokens_needed} tokens exceeds the token limits | Session: {session_id}")
+        raise HTTPException(status_code=413, detail="The request needs more tokens than the rate limit allows.")
+    # The query parameter is caller-controlled, so it can only ask for up to ADMISSION_MAX_PRIORITY
+    priority = max(0, min(priority, settings.ADMISSION_MAX_PRIORITY))
 
-    token_tracker.add_usage(estimated_tokens_needed)
+    # Cached answers skip admission and the agent loop entirely
+    if settings.ANSWER_CACHE_ENABLED and request is not None and request["cacheable"]:
+        answer = await answer_cache.lookup(prompt, db_name, request["schema_fingerprint"])
+        if answer is not None:
+            logger.info(f"(API) Answer cache hit | Session: {session_id}")
+            start_time = time.perf_counter()
+
+            async def cached_stream():
+                async for frame in replay_answer(answer):
+                    yield frame
+                logger.log_on_chat_end(
+                    session_id, prompt, request["system_prompt"] + request["context"] + prompt, answer, start_time,
+                    0, 0, 0, get_model(), None, 0, cache_hit=True
+                )
+
+            return StreamingResponse(cached_stream(), media_type="text/event-stream")
+
+    async def admitted_stream():
+        reservation = None
+        async for status, value in admission_queue.admit(estimated_tokens_needed, session_id, db_name, priority):
+            if status == "queued":
+                yield f"event: queue\ndata: {json.dumps({'position': value})}\n\n"
+            elif status == "admitted":
+                reservation = value
+        if reservation is None:
+            yield "RATE_LIMIT_ERROR: Too many requests are being processed, please wait 30 seconds.\n\n"
+            return
+
+        def on_usage(actual_tokens: int):
+            reservation.commit(actual_tokens)
+            admission_queue.notify()
+
+        async for chunk in run_agent(prompt, session_id, db_name, request, on_usage):
+            yield chunk
     
-    return StreamingResponse(run_agent(prompt, session_id, db_name), media_type="text/event-stream")
+    return StreamingResponse(admitted_stream(), media_type="text/event-stream")
 
 
 @app.get("/session")
@@ -64,35 +166,123 @@ def new_session():
 async def upload_file(file: UploadFile = File(...), session_id: str = "default"):
     try:
        result = await process_file(file, session_id)
-       logger.info(f"(API) New file uploaded")
+       logger.info("(API) New file uploaded")
        return result
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"(API) Error processing file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
     
 
 @app.get("/download/{id}")
-def download_file(id: int):
-    file_record = get_file_from_temp_table(id)
+async def download_file(id: int, request: Request):
+    file_record = await get_download_info(id)
 
     if not file_record:
         raise HTTPException(status_code=404, detail="File not found")
 
-    if not file_record["content"]:
+    if not file_record["size"]:
         raise HTTPException(status_code=404, detail="No binary content available")
 
-    return StreamingResponse(
-        io.BytesIO(file_record["content"]),
-        media_type=file_record["file_type"],
-        headers={"Content-Disposition": f"attachment; filename={file_record['filename']}"}
-    )
+    size = file_record["size"]
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # Ranges are always served from the identity encoding, which carries the plain ETag
+    use_range = bool(range_header) and (not if_range or if_range.strip() == file_record["etag"])
+    encoding = None if use_range else choose_encoding(request.headers.get("accept-encoding"))
+
+    headers = {
+        "Content-Disposition": f"attachment; filename={file_record['filename']}",
+        "ETag": encoded_etag(file_record["etag"], encoding),
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = parse_range(range_header, size) if use_range else None
+
+    # Content is paged out of Postgres in chunks rather than loaded whole
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            iter_file_content(file_record, start, end), status_code=206, media_type=file_record["file_type"], headers=headers
+        )
+
+    if encoding == "zstd" and file_record["blob"]:
+        # The blob is already a zstd frame: send it as stored
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(file_record["stored_size"])
+        return StreamingResponse(iter_blob_compressed(file_record), media_type=file_record["file_type"], headers=headers)
+
+    body = iter_file_content(file_record, 0, size - 1)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        body = compress_stream(body, encoding)
+    else:
+        headers["Content-Length"] = str(size)
+    return StreamingResponse(body, media_type=file_record["file_type"], headers=headers)
     
 @app.get("/database_names")
-def get_database_names():
-    with UserRepository() as repo:
-        db_names = repo.get_database_names()
+async def get_database_names():
+    async with UserRepository() as repo:
+        db_names = await repo.get_database_names()
         return db_names
 
+@app.get("/admin/metrics")
+def get_metrics():
+    return {
+        "db_pools": pool_stats(),
+        "migrations": migration_stats(),
+        "log_handler": logger.handler_stats(),
+        "schema_cache": schema_cache_stats(),
+        "mcp_sessions": mcp_sessions.get_stats(),
+        "agent_cache": agent_cache.get_stats(),
+        "token_usage": token_tracker.get_stats(),
+        "admission_queue": admission_queue.get_stats(),
+        "chat_writer": chat_writer.get_stats(),
+        "file_context": file_context_stats(),
+        "doc_index": doc_index_stats(),
+        "answer_cache": answer_cache.get_stats(),
+        "tool_cache": tool_cache.get_stats(),
+        "blob_store": blob_store_stats(),
+        "maintenance": maintenance_stats(),
+    }
+
+@app.get("/admin/storage")
+async def get_storage_report():
+    return await storage_report()
+
+@app.post("/admin/storage/migrate")
+async def migrate_storage():
+    """Move any inline file content into the blob store now instead of waiting for the background task"""
+    return await migrate_to_blobs()
+
+@app.post("/admin/maintenance/run")
+async def run_maintenance_now():
+    """Premake/drop log partitions and delete stale files now instead of waiting for the background task"""
+    return await run_maintenance_once()
+
+@app.post("/admin/schema_cache/invalidate")
+def invalidate_schema(db_name: str = None):
+    invalidated = invalidate_schema_cache(db_name)
+    return {"invalidated": invalidated}
+
+@app.post("/admin/answer_cache/invalidate")
+def invalidate_answers(db_name: str = None):
+    """Call after loading new data into db_name so cached answers are not served stale"""
+    removed = answer_cache.invalidate(db_name)
+    return {"invalidated": removed}
+
+@app.post("/admin/tool_cache/invalidate")
+def invalidate_tool_results(db_name: str = None):
+    """Call after loading new data into db_name so cached query results are not served stale"""
+    removed = tool_cache.invalidate(db_name)
+    return {"invalidated": removed}
+
 # if __name__ == "__main__":
 #     uvicorn.run("main:app", host=settings.FASTAPI_HOST, port=settings.FASTAPI_PORT)
     
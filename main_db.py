@@ -1,130 +1,250 @@
-from settings import Settings
-import psycopg2
-from llm_logger import LLMLogger
-from db_memory import ensure_chat_history_table_exists
-
-settings = Settings()
-
-logger = LLMLogger()
-
-connection_params = {
-    "host": settings.DB_HOST,
-    "port": settings.DB_PORT,
-    "user": settings.DB_USER,
-    "password": settings.DB_PASSWORD,
-    "dbname": settings.DB_NAME,
-}
-
-def create_tables():
-    ensure_app_logs_exists()
-    ensure_llm_logs_table()
-    ensure_chat_history_table_exists() 
-    ensure_uploaded_files_table()
-    ensure_modified_files_table()
-    ensure_db_table()
-    
-
-
-def ensure_db_table():
-    create_table_sql = """
-        CREATE TABLE IF NOT EXISTS available_databases (
+import time
+
+from psycopg import sql
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_connection
+from partitions import partitioned_tables, convert_to_partitioned
+
+settings = get_settings()
+
+logger = get_logger()
+
+# Held for the migration transaction so only one worker migrates; the others wait and then take the fast path
+MIGRATION_LOCK_ID = 0x7262636861740002
+
+_stats = {"version": None, "applied": [], "fast_path": None, "seconds": None}
+
+
+def ensure_app_logs_exists(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS app_logs (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        level TEXT NOT NULL,
+        message TEXT NOT NULL,
+        logger_name TEXT,
+        module TEXT,
+        function TEXT,
+        line_number INT
+    );
+    """)
+
+def ensure_llm_logs_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS llm_logs (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP with time zone,
+        model_name TEXT NOT null,
+        prompt TEXT NOT NULL,
+        response TEXT NOT NULL,
+        input_tokens INT,
+        output_tokens INT,
+        total_tokens INT,
+        tool_name TEXT
+    );
+    ALTER TABLE llm_logs ADD COLUMN IF NOT EXISTS cached_tokens INT;
+    ALTER TABLE llm_logs ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN NOT NULL DEFAULT FALSE;
+    """)
+
+def ensure_chat_history_table_exists(cur):
+    # Same layout as PostgresChatMessageHistory.create_tables, which commits on its own
+    cur.execute(sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {table} (
+        id SERIAL PRIMARY KEY,
+        session_id UUID NOT NULL,
+        message JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """).format(table=sql.Identifier(settings.DB_CHAT_HISTORY_TABLE)))
+
+def ensure_db_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS available_databases (
         id SERIAL PRIMARY KEY,
         database_name TEXT NOT NULL UNIQUE,
         description TEXT,
         default_db BOOLEAN NOT NULL DEFAULT FALSE
     );
-    """
-    try:
-        with psycopg2.connect(**connection_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute(create_table_sql)
-        logger.info('(API) Ensured available_databases exists')
-    except Exception as e:
-        logger.error(f'(API) Error ensuring available_databases exists: {e}')
+    """)
+
+def ensure_blobs_table(cur):
+    # Content-addressed file payloads (xxh3-128 of the uncompressed bytes), each stored once, zstd-compressed.
+    # EXTERNAL storage: already compressed, and /download pages through it with substring()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size BIGINT NOT NULL,
+        stored_size BIGINT NOT NULL,
+        data BYTEA NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    ALTER TABLE blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+    """)
 
-def ensure_uploaded_files_table():
-    create_table_sql = """
+def ensure_uploaded_files_table(cur):
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS uploaded_files (
         id SERIAL PRIMARY KEY,
         session_id TEXT NOT NULL,
         filename TEXT NOT NULL,
         file_type TEXT NOT NULL,
-        data JSONB NOT NULL,
+        data JSONB,
         upload_time TIMESTAMPTZ NOT NULL DEFAULT NOW()
     );
-    """
-    try:
-        with psycopg2.connect(**connection_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute(create_table_sql)
-        logger.info('(API) Ensured uploaded_files exists')
-    except Exception as e:
-        logger.error(f'(API) Error ensuring uploaded_files exists: {e}')
+    -- Parsed uploads are stored zstd-compressed: columnar JSON for tables, UTF-8 for text
+    ALTER TABLE uploaded_files ALTER COLUMN data DROP NOT NULL;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS content_kind TEXT;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS parsed_content BYTEA;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS raw_content BYTEA;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS row_count INT;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS byte_size BIGINT;
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS chunk_count INT;
+    -- Content hashes into blobs; parsed_content/raw_content/data are only set on rows not yet migrated
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS raw_blob TEXT REFERENCES blobs(hash);
+    ALTER TABLE uploaded_files ADD COLUMN IF NOT EXISTS parsed_blob TEXT REFERENCES blobs(hash);
+    CREATE INDEX IF NOT EXISTS idx_uploaded_files_raw_blob ON uploaded_files (raw_blob);
+    CREATE INDEX IF NOT EXISTS idx_uploaded_files_session_id ON uploaded_files (session_id, upload_time DESC);
+    -- Unreferenced-blob cleanup looks blobs up by every referencing column
+    CREATE INDEX IF NOT EXISTS idx_uploaded_files_parsed_blob ON uploaded_files (parsed_blob);
+    """)
 
-def ensure_llm_logs_table():
-        try:
-            conn = psycopg2.connect(**connection_params)
-            with conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS llm_logs (
-                            id SERIAL PRIMARY KEY,
-                            timestamp TIMESTAMP with time zone,
-                            model_name TEXT NOT null,
-                            prompt TEXT NOT NULL,
-                            response TEXT NOT NULL,
-                            input_tokens INT,
-                            output_tokens INT,
-                            total_tokens INT,
-                            tool_name TEXT
-                        );
-                    """)
-            logger.info("(API) llm_logs table ensured successfully.")
-        except Exception as e:
-            logger.error(f"(API) Failed to create llm_logs table: {e}")
-    
-def ensure_app_logs_exists():
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS app_logs (
-            id SERIAL PRIMARY KEY,
-            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            level TEXT NOT NULL,
-            message TEXT NOT NULL,
-            logger_name TEXT,
-            module TEXT,
-            function TEXT,
-            line_number INT
-        );
-        """
-        conn = None
-        try:
-            conn = psycopg2.connect(**connection_params)
-            with conn:
-                with conn.cursor() as cur:
-                    cur.execute(create_table_sql)
-            logger.info("(API) Ensured app_logs table exists")
-        except Exception as e:
-            print(f"(API) Failed to ensure app_logs exists: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-def ensure_modified_files_table():
-    create_table_sql = """
+def ensure_upload_chunks_table(cur):
+    # Embedded chunks of large text uploads, searched per query instead of sending the whole file
+    cur.execute(f"""
+    CREATE EXTENSION IF NOT EXISTS vector;
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        id BIGSERIAL PRIMARY KEY,
+        upload_id INT NOT NULL REFERENCES uploaded_files(id) ON DELETE CASCADE,
+        session_id TEXT NOT NULL,
+        chunk_index INT NOT NULL,
+        content TEXT NOT NULL,
+        token_count INT NOT NULL,
+        embedding vector({settings.EMBEDDING_DIM}) NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_upload_chunks_upload_id ON upload_chunks (upload_id);
+    CREATE INDEX IF NOT EXISTS idx_upload_chunks_embedding ON upload_chunks USING hnsw (embedding vector_cosine_ops);
+    """)
+
+def ensure_modified_files_table(cur):
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS modified_files (
         id SERIAL PRIMARY KEY,
         session_id TEXT NOT NULL,
         filename TEXT NOT NULL,
         file_type TEXT NOT NULL,
-        content BYTEA,              
-        data JSONB,           
+        content BYTEA,
+        data JSONB,
         upload_time TIMESTAMPTZ DEFAULT NOW()
     );
+    -- Uncompressed out-of-line storage lets /download page through content with substring()
+    -- without detoasting the whole value for every chunk (applies to rows written from now on)
+    ALTER TABLE modified_files ALTER COLUMN content SET STORAGE EXTERNAL;
+    -- The MCP server writes content inline; the blob migrator moves it into blobs
+    ALTER TABLE modified_files ADD COLUMN IF NOT EXISTS content_blob TEXT REFERENCES blobs(hash);
+    CREATE INDEX IF NOT EXISTS idx_modified_files_content_blob ON modified_files (content_blob);
+    CREATE INDEX IF NOT EXISTS idx_modified_files_session_id ON modified_files (session_id, upload_time DESC);
+    """)
+
+def ensure_token_buckets_table(cur):
+    # Unlogged: the shared rate-limit state is cheap to lose on a crash and is written constantly
+    cur.execute("""
+    CREATE UNLOGGED TABLE IF NOT EXISTS token_buckets (
+        name TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    );
+    """)
+
+def base_schema(cur):
+    # Idempotent, so it also brings databases created before schema_version existed up to date
+    ensure_app_logs_exists(cur)
+    ensure_llm_logs_table(cur)
+    ensure_chat_history_table_exists(cur)
+    ensure_blobs_table(cur)
+    ensure_uploaded_files_table(cur)
+    ensure_upload_chunks_table(cur)
+    ensure_modified_files_table(cur)
+    ensure_db_table(cur)
+    ensure_token_buckets_table(cur)
+
+def partition_log_tables(cur):
+    # Log tables are range-partitioned by time so retention can drop whole partitions (see maintenance.py).
+    # Indexes are created after the conversion so they land on the partitioned table and every partition.
+    for table, (column, _) in partitioned_tables().items():
+        convert_to_partitioned(cur, table, column)
+    chat_history = settings.DB_CHAT_HISTORY_TABLE
+    cur.execute(sql.SQL("""
+    CREATE INDEX IF NOT EXISTS idx_app_logs_timestamp ON app_logs (timestamp);
+    CREATE INDEX IF NOT EXISTS idx_llm_logs_timestamp ON llm_logs (timestamp);
+    CREATE INDEX IF NOT EXISTS {session_index} ON {table} (session_id);
+    CREATE INDEX IF NOT EXISTS {session_id_index} ON {table} (session_id, id DESC);
+    """).format(
+        table=sql.Identifier(chat_history),
+        session_index=sql.Identifier(f"idx_{chat_history}_session_id"),
+        session_id_index=sql.Identifier(f"idx_{chat_history}_session_id_id"),
+    ))
+
+# (version, name, migration). Append new entries; never edit or reorder applied ones.
+MIGRATIONS = [
+    (1, "base schema", base_schema),
+    (2, "partition log tables", partition_log_tables),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_version(cur) -> int:
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT coalesce(max(version), 0) FROM schema_version;")
+    return cur.fetchone()[0]
+
+
+def run_migrations():
+    """Bring the schema to LATEST_VERSION on one pooled connection, in one transaction.
+
+    When the recorded version is current this is two catalog lookups and nothing is locked.
+    Otherwise an advisory lock serialises workers booting together; the ones that waited
+    re-read the version and find nothing left to do. A failing migration rolls back all of
+    them and fails startup.
     """
+    start_time = time.perf_counter()
+    applied = []
     try:
-        with psycopg2.connect(**connection_params) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(create_table_sql)
-        logger.info('(API) Ensured modified_files exists')
+                version = _current_version(cur)
+                fast_path = version >= LATEST_VERSION
+                if not fast_path:
+                    cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            version INT PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                        );
+                    """)
+                    version = _current_version(cur)
+                    for migration_version, name, migrate in MIGRATIONS:
+                        if migration_version <= version:
+                            continue
+                        migrate(cur)
+                        cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s);", (migration_version, name))
+                        applied.append(migration_version)
+                        version = migration_version
     except Exception as e:
-        logger.error(f'(API) Error ensuring modified_files table: {e}')
+        logger.error(f"(API) Schema migration failed: {e}")
+        raise
+
+    elapsed = time.perf_counter() - start_time
+    _stats.update(version=version, applied=applied, fast_path=fast_path, seconds=round(elapsed, 4))
+    if applied:
+        logger.info(f"(API) Applied schema migrations {applied} in {elapsed:.3f}s; schema at version {version}")
+    else:
+        logger.info(f"(API) Schema at version {version}, checked in {elapsed * 1000:.1f}ms")
+
+
+def migration_stats() -> dict:
+    return dict(_stats)
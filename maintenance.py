@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_connection
+from partitions import partitioned_tables, create_upcoming_partitions, drop_expired_partitions
+
+settings = get_settings()
+logger = get_logger()
+
+# Any constant works; it only has to be the same in every API worker
+MAINTENANCE_LOCK_ID = 0x7262636861740001
+
+_stats = {
+    "runs": 0,
+    "skipped": 0,
+    "failures": 0,
+    "partitions_created": 0,
+    "partitions_dropped": 0,
+    "uploads_deleted": 0,
+    "modified_files_deleted": 0,
+    "blobs_deleted": 0,
+    "last_run_seconds": None,
+}
+
+
+async def _maintain_partitions(result: dict):
+    # Separate transactions per table and step keep the locks on the parent table short, and a
+    # failing create does not roll back (and so stall) retention, or the other way round
+    for table, (column, retention_days) in partitioned_tables().items():
+        steps = (
+            ("partitions_created", "creating partitions", lambda cur: create_upcoming_partitions(cur, table, column)),
+            ("partitions_dropped", "dropping partitions", lambda cur: drop_expired_partitions(cur, table, retention_days)),
+        )
+        for key, action, step in steps:
+            try:
+                async with get_async_connection() as conn:
+                    async with conn.cursor() as cur:
+                        result[key] += await step(cur)
+            except Exception as e:
+                _stats["failures"] += 1
+                logger.error(f"(API) {action.capitalize()} of {table} failed: {e}")
+
+
+async def _delete_stale_files(cur, table: str, ttl_days: int) -> int:
+    """Delete every file of sessions whose newest file in table is older than ttl_days.
+
+    Files of a session that is still in use are kept together, so the latest upload
+    never outlives the ones it is compared against.
+    """
+    if ttl_days <= 0:
+        return 0
+    await cur.execute(f"""
+        DELETE FROM {table}
+        WHERE session_id IN (
+            SELECT session_id FROM {table}
+            GROUP BY session_id
+            HAVING max(upload_time) < now() - make_interval(days => %s)
+        );
+    """, (ttl_days,))
+    return cur.rowcount
+
+
+async def _delete_unreferenced_blobs(cur) -> int:
+    # The grace period keeps blobs written by an upload whose row is not committed yet. Blobs an
+    # upload is deduplicating against are locked by blob_store.put_blob and skipped here.
+    await cur.execute("""
+        DELETE FROM blobs
+        WHERE hash IN (
+            SELECT b.hash FROM blobs b
+            WHERE b.created_at < now() - interval '1 hour'
+              AND NOT EXISTS (SELECT 1 FROM uploaded_files WHERE raw_blob = b.hash)
+              AND NOT EXISTS (SELECT 1 FROM uploaded_files WHERE parsed_blob = b.hash)
+              AND NOT EXISTS (SELECT 1 FROM modified_files WHERE content_blob = b.hash)
+            FOR UPDATE SKIP LOCKED
+        );
+    """)
+    return cur.rowcount
+
+
+async def _cleanup_files(result: dict):
+    try:
+        async with get_async_connection() as conn:
+            async with conn.cursor() as cur:
+                # upload_chunks rows go with their upload (ON DELETE CASCADE)
+                result["uploads_deleted"] = await _delete_stale_files(cur, "uploaded_files", settings.UPLOAD_TTL_DAYS)
+                result["modified_files_deleted"] = await _delete_stale_files(cur, "modified_files", settings.MODIFIED_FILE_TTL_DAYS)
+                result["blobs_deleted"] = await _delete_unreferenced_blobs(cur)
+    except Exception as e:
+        _stats["failures"] += 1
+        logger.error(f"(API) File cleanup failed: {e}")
+
+
+async def run_maintenance_once() -> dict:
+    """Premake log partitions, drop expired ones and delete stale files.
+
+    A session-level advisory lock makes concurrent runs from other API workers skip instead of
+    repeating the same work.
+    """
+    start_time = time.perf_counter()
+    result = {"partitions_created": [], "partitions_dropped": [], "uploads_deleted": 0,
+              "modified_files_deleted": 0, "blobs_deleted": 0}
+    async with get_async_connection() as lock_conn:
+        await lock_conn.set_autocommit(True)
+        try:
+            async with lock_conn.cursor() as cur:
+                await cur.execute("SELECT pg_try_advisory_lock(%s);", (MAINTENANCE_LOCK_ID,))
+                acquired = (await cur.fetchone())[0]
+            if not acquired:
+                _stats["skipped"] += 1
+                return {"skipped": True}
+            try:
+                await _maintain_partitions(result)
+                await _cleanup_files(result)
+            finally:
+                async with lock_conn.cursor() as cur:
+                    await cur.execute("SELECT pg_advisory_unlock(%s);", (MAINTENANCE_LOCK_ID,))
+        finally:
+            await lock_conn.set_autocommit(False)
+
+    elapsed = time.perf_counter() - start_time
+    _stats["runs"] += 1
+    _stats["last_run_seconds"] = round(elapsed, 3)
+    for key in ("partitions_created", "partitions_dropped"):
+        _stats[key] += len(result[key])
+    for key in ("uploads_deleted", "modified_files_deleted", "blobs_deleted"):
+        _stats[key] += result[key]
+    logger.info(f"(API) Maintenance finished in {elapsed:.3f}s: {result}")
+    return result
+
+
+async def run_maintenance():
+    """Background task started from the lifespan hook"""
+    while True:
+        try:
+            await run_maintenance_once()
+        except Exception as e:
+            _stats["failures"] += 1
+            logger.error(f"(API) Maintenance run failed: {e}")
+        await asyncio.sleep(settings.MAINTENANCE_INTERVAL)
+
+
+def maintenance_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,178 @@
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
+
+from settings import get_settings
+from llm_logger import get_logger
+from tool_cache import tool_cache
+
+settings = get_settings()
+logger = get_logger()
+
+
+class McpSession:
+    """A warm MCP session for one database.
+
+    The streamable HTTP transport and ClientSession are entered and exited by a
+    dedicated background task, so the session can be shared by many requests.
+    """
+
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self.session = None
+        self.tools = []
+        self.setup_time = 0.0
+        self.last_used = time.monotonic()
+        self.semaphore = asyncio.Semaphore(settings.MCP_SESSION_CONCURRENCY)
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._error = None
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"mcp-session-{self.db_name}")
+        await self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    async def _run(self):
+        # The MCP client stack is imported with the first session rather than on startup
+        from mcp import ClientSession
+        from mcp.client.streamable_http import streamablehttp_client
+        from langchain_mcp_adapters.tools import load_mcp_tools
+
+        start_time = time.perf_counter()
+        try:
+            async with streamablehttp_client(url=settings.MCP_SERVER_URL, headers={'db_name': self.db_name}) as (read, write, _):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    # Wrapped once per session, so the agent cache keeps seeing the same tool objects.
+                    # Cache hits return before taking a concurrency slot
+                    self.tools = [tool_cache.wrap(self._bounded(tool), self.db_name) for tool in await load_mcp_tools(session)]
+                    self.session = session
+                    self.setup_time = time.perf_counter() - start_time
+                    logger.info(f"(API) MCP session for '{self.db_name}' ready in {self.setup_time:.3f}s")
+                    self._ready.set()
+                    await self._closing.wait()
+        except Exception as e:
+            self._error = e
+            logger.error(f"(API) MCP session for '{self.db_name}' failed: {e}")
+        finally:
+            self.session = None
+            self._ready.set()
+
+    def _bounded(self, tool):
+        """A copy of an MCP tool whose calls each hold one of MCP_SESSION_CONCURRENCY slots"""
+        from langchain_core.tools import StructuredTool
+        if not isinstance(tool, StructuredTool) or tool.coroutine is None:
+            return tool
+
+        original = tool.coroutine
+
+        async def bounded_call(**arguments):
+            async with self.semaphore:
+                self.last_used = time.monotonic()
+                return await original(**arguments)
+
+        return tool.model_copy(update={"coroutine": bounded_call})
+
+    def is_alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def check_health(self) -> bool:
+        if not self.is_alive():
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout=settings.MCP_PING_TIMEOUT)
+            return True
+        except Exception as e:
+            logger.error(f"(API) MCP health check for '{self.db_name}' failed: {e}")
+            return False
+
+    async def close(self):
+        self._closing.set()
+        if self._task is not None:
+            with suppress(Exception):
+                await self._task
+
+
+class McpSessionManager:
+    """Keeps one warm MCP session (and its loaded tools) per db_name"""
+
+    def __init__(self):
+        self._sessions: dict[str, McpSession] = {}
+        self._locks = defaultdict(asyncio.Lock)
+        self.stats = {
+            "cold_starts": 0,
+            "warm_hits": 0,
+            "reconnects": 0,
+            "setup_time_saved": 0.0,
+        }
+
+    async def _get_session(self, db_name: str) -> McpSession:
+        async with self._locks[db_name]:
+            mcp = self._sessions.get(db_name)
+            if mcp is not None:
+                idle_time = time.monotonic() - mcp.last_used
+                healthy = mcp.is_alive()
+                if healthy and idle_time > settings.MCP_HEALTH_CHECK_INTERVAL:
+                    healthy = await mcp.check_health()
+                if healthy:
+                    self.stats["warm_hits"] += 1
+                    self.stats["setup_time_saved"] += mcp.setup_time
+                    return mcp
+
+                logger.info(f"(API) Reconnecting MCP session for '{db_name}'")
+                self.stats["reconnects"] += 1
+                await self._discard(db_name, mcp)
+
+            mcp = McpSession(db_name)
+            await mcp.start()
+            self.stats["cold_starts"] += 1
+            self._sessions[db_name] = mcp
+            return mcp
+
+    async def _discard(self, db_name: str, mcp: McpSession):
+        if self._sessions.get(db_name) is mcp:
+            del self._sessions[db_name]
+        await mcp.close()
+
+    @asynccontextmanager
+    async def acquire(self, db_name: str):
+        """Borrow the warm session for db_name.
+
+        Only tool calls are bounded by MCP_SESSION_CONCURRENCY (see McpSession._bounded), so model
+        thinking time and SSE delivery of a chat do not hold one of the session's slots.
+        """
+        mcp = await self._get_session(db_name)
+        mcp.last_used = time.monotonic()
+        try:
+            yield mcp
+        except Exception:
+            # Drop the session if the failure came from the transport so the next request reconnects
+            if not await mcp.check_health():
+                async with self._locks[db_name]:
+                    await self._discard(db_name, mcp)
+            raise
+        finally:
+            mcp.last_used = time.monotonic()
+
+    async def close_all(self):
+        sessions = list(self._sessions.items())
+        self._sessions.clear()
+        for db_name, mcp in sessions:
+            await mcp.close()
+            logger.info(f"(API) Closed MCP session for '{db_name}'")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "sessions": {
+                db_name: {"alive": mcp.is_alive(), "tools": len(mcp.tools), "setup_time": mcp.setup_time}
+                for db_name, mcp in self._sessions.items()
+            },
+        }
+
+
+mcp_sessions = McpSessionManager()
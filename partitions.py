@@ -0,0 +1,192 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from psycopg import sql
+
+from settings import get_settings
+from llm_logger import get_logger
+
+settings = get_settings()
+logger = get_logger()
+
+BOUND_PATTERN = re.compile(r"FROM \((MINVALUE|'[^']*')\) TO \((MAXVALUE|'[^']*')\)")
+
+
+def partitioned_tables() -> dict[str, tuple[str, int]]:
+    """table -> (partition column, retention in days; 0 keeps everything)"""
+    tables = {
+        "app_logs": ("timestamp", settings.APP_LOGS_RETENTION_DAYS),
+        "llm_logs": ("timestamp", settings.LLM_LOGS_RETENTION_DAYS),
+    }
+    # History is read per session without a time bound, so every partition is probed on each read;
+    # only worth it when retention actually drops old partitions
+    if settings.CHAT_HISTORY_RETENTION_DAYS > 0:
+        tables[settings.DB_CHAT_HISTORY_TABLE] = ("created_at", settings.CHAT_HISTORY_RETENTION_DAYS)
+    return tables
+
+
+def period_start(moment: datetime) -> datetime:
+    moment = moment.astimezone(timezone.utc)
+    if settings.LOG_PARTITION_INTERVAL == "month":
+        return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start: datetime) -> datetime:
+    if settings.LOG_PARTITION_INTERVAL == "month":
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    suffix = start.strftime("%Y%m") if settings.LOG_PARTITION_INTERVAL == "month" else start.strftime("%Y%m%d")
+    return f"{table}_p{suffix}"
+
+
+def _parse_bound(text: str):
+    if text in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(text.strip("'"))
+
+
+def convert_to_partitioned(cur, table: str, column: str):
+    """Turn a plain table into one range-partitioned on column, in the caller's transaction.
+
+    The existing table is kept as the `<table>_legacy` partition covering everything up to the
+    end of the current period, so no rows are copied; it is dropped whole once it ages out.
+    Later partitions are created ahead of time by the maintenance task.
+    """
+    legacy = f"{table}_legacy"
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    if row is None or row[0] == "p":
+        return
+
+    cur.execute(sql.SQL("SELECT pg_get_serial_sequence(%s, 'id'), max({column}) FROM {table}").format(
+        column=sql.Identifier(column), table=sql.Identifier(table)), (table,))
+    sequence, latest = cur.fetchone()
+    upper = next_period(period_start(datetime.now(timezone.utc)))
+    while latest is not None and latest >= upper:
+        upper = next_period(upper)
+
+    params = {
+        "table": sql.Identifier(table),
+        "legacy": sql.Identifier(legacy),
+        "column": sql.Identifier(column),
+        "pkey": sql.Identifier(f"{table}_pkey"),
+        "legacy_pkey": sql.Identifier(f"{legacy}_pkey"),
+        "default": sql.Identifier(f"{table}_default"),
+        "upper": sql.Literal(upper.isoformat()),
+    }
+    statements = [
+        "ALTER TABLE {table} RENAME TO {legacy}",
+        "ALTER TABLE {legacy} RENAME CONSTRAINT {pkey} TO {legacy_pkey}",
+        "UPDATE {legacy} SET {column} = to_timestamp(0) WHERE {column} IS NULL",
+        "ALTER TABLE {legacy} ALTER COLUMN {column} SET NOT NULL",
+        "CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})",
+        "ALTER TABLE {table} ADD CONSTRAINT {pkey} PRIMARY KEY (id, {column})",
+        "ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ({upper})",
+        "CREATE TABLE {default} PARTITION OF {table} DEFAULT",
+    ]
+    for statement in statements:
+        cur.execute(sql.SQL(statement).format(**params))
+    # Free the index names so partition_log_tables can recreate them on the partitioned table
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname <> %s", (legacy, f"{legacy}_pkey"))
+    for (index,) in cur.fetchall():
+        cur.execute(sql.SQL("ALTER INDEX {index} RENAME TO {renamed}").format(
+            index=sql.Identifier(index), renamed=sql.Identifier(f"{index[:56]}_legacy")))
+    if sequence:
+        # The id sequence belonged to the legacy table; keep it alive when that partition is dropped
+        cur.execute(sql.SQL("ALTER SEQUENCE {sequence} OWNED BY {table}.id").format(
+            sequence=sql.SQL(sequence), table=sql.Identifier(table)))
+    logger.info(f"(API) Converted {table} to a partitioned table; existing rows kept in {legacy}")
+
+
+async def _list_partitions(cur, table: str) -> list[tuple[str, datetime, datetime, bool]]:
+    """(name, lower, upper, is_default) for each partition; None bounds are MINVALUE/MAXVALUE"""
+    await cur.execute("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.oid = to_regclass(%s);
+    """, (table,))
+    partitions = []
+    for name, bound in await cur.fetchall():
+        match = BOUND_PATTERN.search(bound)
+        if match is None:
+            partitions.append((name, None, None, True))
+        else:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2)), False))
+    return partitions
+
+
+async def _create_partition(cur, table: str, column: str, name: str, default: str, start: datetime, end: datetime):
+    """CREATE ... PARTITION OF, first moving rows of that range out of the default partition.
+
+    Postgres refuses the new partition while the default one holds rows it would cover, which
+    happens after any gap in maintenance. The default is detached while its rows are moved.
+    """
+    params = {
+        "table": sql.Identifier(table),
+        "name": sql.Identifier(name),
+        "column": sql.Identifier(column),
+        "start": sql.Literal(start.isoformat()),
+        "end": sql.Literal(end.isoformat()),
+    }
+    stranded = False
+    if default is not None:
+        params["default"] = sql.Identifier(default)
+        await cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {default} WHERE {column} >= {start} AND {column} < {end})").format(**params))
+        stranded = (await cur.fetchone())[0]
+
+    if not stranded:
+        await cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})").format(**params))
+        return
+
+    statements = [
+        "ALTER TABLE {table} DETACH PARTITION {default}",
+        "CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})",
+        "INSERT INTO {name} SELECT * FROM {default} WHERE {column} >= {start} AND {column} < {end}",
+        "DELETE FROM {default} WHERE {column} >= {start} AND {column} < {end}",
+        "ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT",
+    ]
+    for statement in statements:
+        await cur.execute(sql.SQL(statement).format(**params))
+    logger.info(f"(API) Moved rows of {name} out of {default}")
+
+
+async def create_upcoming_partitions(cur, table: str, column: str) -> list[str]:
+    """Create the current and next LOG_PARTITION_PREMAKE partitions that do not overlap existing ones"""
+    partitions = await _list_partitions(cur, table)
+    existing = [(lower, upper) for _, lower, upper, is_default in partitions if not is_default]
+    if not existing:
+        # Not partitioned (conversion failed or table missing)
+        return []
+    default = next((name for name, _, _, is_default in partitions if is_default), None)
+
+    created = []
+    start = period_start(datetime.now(timezone.utc))
+    for _ in range(settings.LOG_PARTITION_PREMAKE + 1):
+        end = next_period(start)
+        overlaps = any((lower is None or lower < end) and (upper is None or start < upper) for lower, upper in existing)
+        if not overlaps:
+            name = partition_name(table, start)
+            await _create_partition(cur, table, column, name, default, start, end)
+            created.append(name)
+        start = end
+    return created
+
+
+async def drop_expired_partitions(cur, table: str, retention_days: int) -> list[str]:
+    """Drop whole partitions whose upper bound is older than the retention window"""
+    if retention_days <= 0:
+        return []
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    dropped = []
+    for name, _, upper, is_default in await _list_partitions(cur, table):
+        if is_default or upper is None or upper > cutoff:
+            continue
+        await cur.execute(sql.SQL("DROP TABLE {name}").format(name=sql.Identifier(name)))
+        dropped.append(name)
+    return dropped
@@ -1,32 +1,113 @@
 import logging
+import queue
+import threading
+import time
 import psycopg2
+from psycopg2.extras import execute_values
 from datetime import datetime, timezone
 
+_STOP = object()
+
+
 class PostgresHandler(logging.Handler):
-    def __init__(self, connection_params):
+    """Buffers app_logs records in a bounded queue and writes them in batches from a background thread"""
+
+    def __init__(self, connection_params, batch_size: int = 200, flush_interval: float = 1.0, max_queue_size: int = 10000):
         super().__init__()
         self.connection_params = connection_params
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.written = 0
+        self._conn = None
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="postgres-log-writer", daemon=True)
+        self._worker.start()
 
     def emit(self, record):
         try:
-            conn = psycopg2.connect(**self.connection_params)
-            with conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
+            row = (
+                datetime.fromtimestamp(record.created, timezone.utc),
+                record.levelname,
+                record.getMessage(),
+                record.name,
+                record.module,
+                record.funcName,
+                record.lineno
+            )
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._drain(batch)
+                self._flush(batch)
+                break
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+        if self._conn:
+            self._conn.close()
+
+    def _drain(self, batch):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                batch.append(item)
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(**self.connection_params)
+            with self._conn:
+                with self._conn.cursor() as cur:
+                    execute_values(cur, """
                         INSERT INTO app_logs (timestamp, level, message, logger_name, module, function, line_number)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s);
-                    """, (
-                        datetime.now(timezone.utc),
-                        record.levelname,
-                        record.getMessage(),
-                        record.name,
-                        record.module,
-                        record.funcName,
-                        record.lineno
-                    ))
+                        VALUES %s;
+                    """, batch, page_size=self.batch_size)
+            self.written += len(batch)
         except Exception as e:
             # fallback to console in case DB logging fails
-            print(f"[PostgresHandler Error] {e}")
-        finally:
-            if conn:
-                conn.close()
\ No newline at end of file
+            print(f"[PostgresHandler Error] Dropping {len(batch)} log records: {e}")
+            self.dropped += len(batch)
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """Flush everything still buffered before the handler goes away"""
+        if not self._closed:
+            self._closed = True
+            self.queue.put(_STOP)
+            self._worker.join()
+        super().close()
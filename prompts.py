@@ -27,6 +27,7 @@ You have access to tools:
     - search_internet: Searches the web for an answer.
     - processed_file: Sends the user a url to download a modified file.
     - export_user_query_to_file: Execute a database query and save it as a csv file
+    - get_table_schema: Returns the columns of tables that are listed by name only in the table info
 
 **Instructions for using run_sql_query tool:**
 
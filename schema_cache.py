@@ -0,0 +1,101 @@
+import time
+from typing import TYPE_CHECKING
+
+from settings import get_settings
+from llm_logger import get_logger
+from user_repository import UserRepository
+from schema_index import SchemaIndex
+
+if TYPE_CHECKING:
+    from langchain_core.tools import StructuredTool
+
+settings = get_settings()
+logger = get_logger()
+
+# db_name -> {"index", "fingerprint", "checked_at"}
+_cache: dict[str, dict] = {}
+_stats = {"hits": 0, "revalidated": 0, "misses": 0}
+# db_name -> get_table_schema tool; created once so the agent cache sees the same tool object
+_schema_tools: dict[str, "StructuredTool"] = {}
+
+
+async def _get_entry(db_name: str) -> dict:
+    """Cached schema for db_name, only hitting the catalog when the cache is stale"""
+    now = time.monotonic()
+    entry = _cache.get(db_name)
+
+    if entry and now - entry["checked_at"] < settings.SCHEMA_CACHE_TTL:
+        _stats["hits"] += 1
+        return entry
+
+    async with UserRepository(dbname=db_name) as repo:
+        fingerprint = await repo.get_schema_fingerprint()
+
+        if entry and fingerprint is not None and fingerprint == entry["fingerprint"]:
+            _stats["revalidated"] += 1
+            entry["checked_at"] = now
+            return entry
+
+        _stats["misses"] += 1
+        logger.info(f"(API) Schema cache miss for database: {db_name}")
+        tables = await repo.get_tables_metadata()
+
+    # A failed fetch returns None, which should not be cached
+    if tables is None:
+        return {"index": SchemaIndex([]), "fingerprint": None, "checked_at": now}
+
+    index = SchemaIndex(tables)
+    entry = {
+        "index": index,
+        "fingerprint": fingerprint,
+        "checked_at": now,
+    }
+    if fingerprint is not None:
+        _cache[db_name] = entry
+    return entry
+
+
+async def get_prompt_schema(db_name: str, question: str) -> tuple[str, str]:
+    """(stable schema text for the system prompt, per-question table details within SCHEMA_TOKEN_BUDGET)"""
+    index = (await _get_entry(db_name))["index"]
+    return index.prefix(settings.SCHEMA_TOKEN_BUDGET), await index.select(question, settings.SCHEMA_TOKEN_BUDGET)
+
+
+def get_schema_tool(db_name: str) -> "StructuredTool":
+    """Tool the agent calls for the columns of tables that were pruned from its prompt"""
+    tool = _schema_tools.get(db_name)
+    if tool is None:
+        from langchain_core.tools import StructuredTool
+
+        async def get_table_schema(table_names: list[str]) -> str:
+            entry = await _get_entry(db_name)
+            return entry["index"].lookup(table_names)
+
+        tool = StructuredTool.from_function(
+            coroutine=get_table_schema,
+            name="get_table_schema",
+            description="Returns the columns, data types and comments of the given database tables. "
+                        "Use it before querying a table whose columns are not listed in the prompt.",
+        )
+        _schema_tools[db_name] = tool
+    return tool
+
+
+def get_schema_fingerprint(db_name: str):
+    entry = _cache.get(db_name)
+    return entry["fingerprint"] if entry else None
+
+
+def invalidate_schema_cache(db_name: str = None) -> list[str]:
+    """Drop the cached schema for db_name, or for every database when db_name is None"""
+    if db_name is None:
+        invalidated = list(_cache)
+        _cache.clear()
+    else:
+        invalidated = [db_name] if _cache.pop(db_name, None) else []
+    logger.info(f"(API) Invalidated schema cache for: {invalidated}")
+    return invalidated
+
+
+def schema_cache_stats() -> dict:
+    return {**_stats, "cached_databases": list(_cache)}
@@ -0,0 +1,152 @@
+import re
+import math
+from collections import Counter
+
+from settings import get_settings
+from llm_logger import get_logger
+from token_counter import count_tokens
+from embeddings import get_embedder
+
+settings = get_settings()
+logger = get_logger()
+
+# Words, plus the parts of snake_case and camelCase identifiers
+TERM_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    terms = []
+    for term in TERM_PATTERN.findall(text or ""):
+        term = term.lower()
+        # Crude plural folding so "orders" matches an "order" table and vice versa
+        if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+def render_table(table: dict) -> str:
+    return f"Table: {table['table']} -- {table['comment']}\n" + "\n".join(
+        f"  - {col} ({dtype})" + (f" -- {comment}" if comment else "")
+        for col, dtype, comment in table["columns"]
+    )
+
+
+def render_tables(tables: list[dict]) -> str:
+    return "\n\n".join(render_table(table) for table in tables)
+
+
+def _table_document(table: dict) -> str:
+    # The table name is repeated so a name match outweighs a stray column match
+    parts = [table["table"]] * 3 + [table["comment"] or ""]
+    for col, _, comment in table["columns"]:
+        parts.append(col)
+        if comment:
+            parts.append(comment)
+    return " ".join(parts)
+
+
+class SchemaIndex:
+    """Ranks a database's tables against a question and renders the best ones under a token budget.
+
+    Built once per schema fingerprint by schema_cache. Scoring is BM25 over table/column names
+    and comments; when SCHEMA_VECTOR_WEIGHT > 0 the cosine similarity of table embeddings is added.
+    """
+
+    def __init__(self, tables: list[dict]):
+        self.tables = tables
+        self.by_name = {table["table"].lower(): table for table in tables}
+        self.rendered = [render_table(table) for table in tables]
+        self.table_tokens = [count_tokens(text) for text in self.rendered]
+        self.full_schema = render_tables(tables)
+        self.full_tokens = count_tokens(self.full_schema)
+
+        documents = [tokenize(_table_document(table)) for table in tables]
+        self.term_freqs = [Counter(document) for document in documents]
+        self.doc_lengths = [len(document) for document in documents]
+        self.avg_length = sum(self.doc_lengths) / len(documents) if documents else 0
+        self.doc_freq = Counter(term for freqs in self.term_freqs for term in freqs)
+        self.vectors = None
+
+    def bm25_scores(self, question: str) -> list[float]:
+        query_terms = set(tokenize(question))
+        n = len(self.tables)
+        scores = []
+        for freqs, length in zip(self.term_freqs, self.doc_lengths):
+            score = 0.0
+            for term in query_terms:
+                tf = freqs.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (n - self.doc_freq[term] + 0.5) / (self.doc_freq[term] + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_length))
+            scores.append(score)
+        return scores
+
+    async def _vector_scores(self, question: str):
+        # Only used when SCHEMA_VECTOR_WEIGHT is set, so numpy is not imported otherwise
+        import numpy as np
+        embedder = get_embedder()
+        if self.vectors is None:
+            documents = [_table_document(table) for table in self.tables]
+            self.vectors = np.asarray(await embedder.embed_documents(documents), dtype=np.float32)
+        query = np.asarray(await embedder.embed_query(question), dtype=np.float32)
+        return self.vectors @ query
+
+    async def scores(self, question: str) -> list[float]:
+        scores = self.bm25_scores(question)
+        if settings.SCHEMA_VECTOR_WEIGHT <= 0 or not self.tables:
+            return scores
+
+        top = max(scores) or 1.0
+        try:
+            similarities = await self._vector_scores(question)
+        except Exception as e:
+            logger.error(f"(API) Schema vector scoring failed, using BM25 only: {e}")
+            return scores
+        return [score / top + settings.SCHEMA_VECTOR_WEIGHT * float(similarity)
+                for score, similarity in zip(scores, similarities)]
+
+    def prefix(self, token_budget: int) -> str:
+        """Schema text for the static system prompt: the full schema when it fits, otherwise table names only.
+
+        Depends only on the schema, so the system prompt stays byte-identical between questions
+        and OpenAI can reuse its cached prefix.
+        """
+        if self.full_tokens <= token_budget:
+            return self.full_schema
+        return (
+            "Tables: " + ", ".join(table["table"] for table in self.tables) + "\n"
+            "Columns of the tables most relevant to the question are listed in a later system message. "
+            "Call get_table_schema to see the columns of any other table before using it."
+        )
+
+    async def select(self, question: str, token_budget: int) -> str:
+        """The tables most relevant to question, rendered in full; empty when prefix() already has the full schema"""
+        if self.full_tokens <= token_budget:
+            return ""
+
+        scores = await self.scores(question)
+        ranked = sorted(range(len(self.tables)), key=lambda i: (-scores[i], i))
+        selected = []
+        used = 0
+        for i in ranked:
+            if scores[i] <= 0:
+                break
+            if used + self.table_tokens[i] > token_budget:
+                continue
+            selected.append(i)
+            used += self.table_tokens[i]
+
+        logger.info(f"(API) Schema pruned to {len(selected)} of {len(self.tables)} tables ({used} of {self.full_tokens} tokens)")
+        return "\n\n".join(self.rendered[i] for i in selected)
+
+    def lookup(self, table_names: list[str]) -> str:
+        found = [self.by_name[name.lower()] for name in table_names if name.lower() in self.by_name]
+        missing = [name for name in table_names if name.lower() not in self.by_name]
+        result = render_tables(found)
+        if missing:
+            result += f"\n\nUnknown tables: {', '.join(missing)}. Available tables: {', '.join(self.by_name)}"
+        return result.strip()
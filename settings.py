@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -6,8 +8,12 @@ load_dotenv()
 
 class Settings(BaseSettings):
     OPENAI_API_KEY: str
+    LLM_MODEL: str = 'gpt-4.1'
     # Chat history memory
     MEMORY_LIMIT: int = 10
+    # Number of sessions whose recent messages are kept in memory; 0 disables the cache.
+    # Per process, so only enable it with a single worker or session-sticky routing
+    HISTORY_CACHE_SIZE: int = 0
     
     # Database configuration
     DB_HOST: str = 'localhost'
@@ -16,9 +22,17 @@ class Settings(BaseSettings):
     DB_PASSWORD: str 
     DB_NAME: str = 'main'
     DB_CHAT_HISTORY_TABLE: str = 'chat_history'
+    DB_POOL_MIN_SIZE: int = 1
+    DB_POOL_MAX_SIZE: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    # How often available_databases may be re-read when an unknown db_name is requested
+    DATABASE_LIST_TTL: float = 60.0
 
     MCP_SERVER_HOST: str 
     MCP_SERVER_PORT: str 
+    MCP_SESSION_CONCURRENCY: int = 8
+    MCP_HEALTH_CHECK_INTERVAL: int = 60
+    MCP_PING_TIMEOUT: float = 5.0
     
     
     ALLOWED_ORIGINS: str = 'http://localhost:5173'
@@ -27,6 +41,9 @@ class Settings(BaseSettings):
     
     ENABLE_LOGGING: bool = True
     LOG_LEVEL: str = 'INFO'
+    LOG_BATCH_SIZE: int = 200
+    LOG_FLUSH_INTERVAL: float = 1.0
+    LOG_QUEUE_SIZE: int = 10000
 
     # SQL Generation Prompt Configuration
     DIALECT: str = 'postgresql'
@@ -35,7 +52,108 @@ class Settings(BaseSettings):
     NEWLINE_CHAR: str  = '^'
     FOLLOWUP_CHAR: str = '~'
 
+    # Seconds before a cached schema is revalidated against the catalog fingerprint
+    SCHEMA_CACHE_TTL: int = 300
+    # Schemas larger than this are pruned to the tables most relevant to the question
+    SCHEMA_TOKEN_BUDGET: int = 3000
+    # Weight of embedding similarity added to BM25 when ranking tables; 0 disables it
+    SCHEMA_VECTOR_WEIGHT: float = 0.0
+
+    # Answer cache for repeated questions (opt-in). Cosine similarity threshold for near-duplicate
+    # questions; 0 means exact normalised matches only
+    ANSWER_CACHE_ENABLED: bool = False
+    ANSWER_CACHE_SIZE: int = 1000
+    ANSWER_CACHE_TTL: float = 3600.0
+    ANSWER_CACHE_SIMILARITY: float = 0.0
+    # Comma-separated tools whose answers are never cached (download links, files)
+    ANSWER_CACHE_EXCLUDED_TOOLS: str = 'export_user_query_to_file,processed_file'
+    ANSWER_CACHE_REPLAY_CHUNK_SIZE: int = 64
+
+    # MCP tool result cache; a TTL of 0 disables it
+    TOOL_CACHE_SIZE: int = 500
+    TOOL_CACHE_TTL: float = 300.0
+    # Comma-separated tools that are always called through (side effects, per-request files)
+    TOOL_CACHE_EXCLUDED_TOOLS: str = 'export_user_query_to_file,processed_file'
+
+    # SSE streaming: buffered tokens are flushed after this many ms or bytes (0 bytes sends every token);
+    # a keep-alive comment is sent after this many idle seconds (0 disables)
+    SSE_FLUSH_INTERVAL_MS: int = 50
+    SSE_FLUSH_BYTES: int = 512
+    SSE_HEARTBEAT_INTERVAL: float = 15.0
+
+    # /download streaming: slice size read per query, and the Content-Encodings offered
+    # (comma-separated from zstd, gzip; empty disables compression)
+    DOWNLOAD_CHUNK_SIZE: int = 262144
+    DOWNLOAD_COMPRESSION: str = 'zstd,gzip'
+    DOWNLOAD_COMPRESSION_LEVEL: int = 3
+
+    # Background move of inline uploaded/modified file content into the deduplicated blob store
+    BLOB_MIGRATION_BATCH_SIZE: int = 50
+    BLOB_MIGRATION_INTERVAL: float = 60.0
+
+    # Log tables are range-partitioned by 'day' or 'month'; retention drops whole partitions (0 keeps all)
+    LOG_PARTITION_INTERVAL: str = 'day'
+    LOG_PARTITION_PREMAKE: int = 3
+    APP_LOGS_RETENTION_DAYS: int = 30
+    LLM_LOGS_RETENTION_DAYS: int = 90
+    # chat_history is only partitioned (by the schema migration) when this is set
+    CHAT_HISTORY_RETENTION_DAYS: int = 0
+    # Files of sessions with no upload/export for this many days are deleted (0 keeps all)
+    UPLOAD_TTL_DAYS: int = 30
+    MODIFIED_FILE_TTL_DAYS: int = 7
+    MAINTENANCE_INTERVAL: float = 3600.0
+
     MAX_FILE_SIZE: int = 5242880
+    UPLOAD_CHUNK_SIZE: int = 65536
+    UPLOAD_CSV_CHUNK_ROWS: int = 10000
+    UPLOAD_COMPRESSION_LEVEL: int = 3
+
+    # Uploaded file context sent to the model
+    FILE_CONTEXT_TOKEN_BUDGET: int = 4000
+    FILE_CONTEXT_CHUNK_SIZE: int = 1500
+    FILE_CONTEXT_CHUNK_OVERLAP: int = 150
+    FILE_CONTEXT_CACHE_SIZE: int = 64
+
+    # Upload chunk embeddings ('openai', or 'hashing' for a deterministic offline embedder).
+    # EMBEDDING_DIM is baked into the upload_chunks column; changing it needs the table rebuilt
+    EMBEDDING_PROVIDER: str = 'openai'
+    EMBEDDING_MODEL: str = 'text-embedding-3-small'
+    EMBEDDING_DIM: int = 512
+    EMBEDDING_BATCH_SIZE: int = 100
+    FILE_RETRIEVAL_TOP_K: int = 8
+
+    # Token admission: model calls per request in the react loop and expected completion size
+    TOKEN_LIMIT_PER_MINUTE: int = 400000
+    # Optional sub-limits, 0 disables them
+    REQUEST_LIMIT_PER_MINUTE: int = 0
+    SESSION_TOKEN_LIMIT_PER_MINUTE: int = 0
+    DB_TOKEN_LIMIT_PER_MINUTE: int = 0
+    # 'local' keeps the budget per process, 'postgres' shares it across workers through token_buckets
+    TOKEN_BACKEND: str = 'local'
+    TOKEN_LEASE_SIZE: int = 20000
+    TOKEN_LEASE_TTL: float = 10.0
+    # A lease covers at least this many requests of the size being admitted (and TOKEN_LEASE_SIZE)
+    TOKEN_LEASE_REQUESTS: int = 4
+
+    # Requests over budget wait in the admission queue instead of being rejected
+    ADMISSION_MAX_QUEUE_DEPTH: int = 100
+    ADMISSION_MAX_WAIT: float = 30.0
+    ADMISSION_POLL_INTERVAL: float = 0.5
+    ADMISSION_POSITION_INTERVAL: float = 1.0
+    # Highest `priority` a /query caller may ask for; 0 ignores client-supplied priorities
+    ADMISSION_MAX_PRIORITY: int = 0
+    TOKEN_ESTIMATE_MODEL_CALLS: int = 2
+    TOKEN_ESTIMATE_OUTPUT_TOKENS: int = 1000
+    TOKEN_ESTIMATE_FALLBACK: int = 15000
+
+    # Write-behind persistence of chat history and llm_logs
+    CHAT_WRITE_BATCH_SIZE: int = 50
+    CHAT_WRITE_FLUSH_INTERVAL: float = 0.5
+    CHAT_WRITE_QUEUE_SIZE: int = 1000
+    CHAT_WRITE_MAX_RETRIES: int = 3
+
+    # Number of compiled react agents kept in memory
+    AGENT_CACHE_SIZE: int = 32
 
     @property
     def MCP_SERVER_URL(self) -> str:
@@ -44,3 +162,9 @@ class Settings(BaseSettings):
     class Config:
         env_file = ".env"
         extra = "allow"
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """The process-wide Settings; parsing the environment once instead of in every module"""
+    return Settings()
@@ -0,0 +1,86 @@
+import time
+import asyncio
+from contextlib import suppress
+from typing import AsyncIterator
+
+from settings import get_settings
+
+settings = get_settings()
+
+HEARTBEAT_FRAME = ": keep-alive\n\n"
+
+
+def data_frame(text: str) -> str:
+    return f"data: {text}\n\n"
+
+
+async def coalesce_sse(
+    deltas: AsyncIterator[str],
+    flush_interval: float = settings.SSE_FLUSH_INTERVAL_MS / 1000,
+    flush_bytes: int = settings.SSE_FLUSH_BYTES,
+    heartbeat_interval: float = settings.SSE_HEARTBEAT_INTERVAL,
+):
+    """Turn a stream of text deltas into SSE data frames, batching small deltas.
+
+    The first delta is sent on its own so time-to-first-token is unchanged. After that,
+    deltas are buffered until flush_bytes have accumulated or flush_interval has passed
+    since the oldest buffered delta. While nothing arrives (e.g. during a long tool call)
+    a comment frame is sent every heartbeat_interval seconds; 0 disables heartbeats.
+    """
+    iterator = deltas.__aiter__()
+    pending = asyncio.ensure_future(iterator.__anext__())
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    first = True
+    error = None
+
+    try:
+        while True:
+            if buffer:
+                timeout = max(0.0, deadline - time.monotonic())
+            else:
+                timeout = heartbeat_interval or None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                if buffer:
+                    yield data_frame("".join(buffer))
+                    buffer, buffered_bytes, deadline = [], 0, None
+                else:
+                    yield HEARTBEAT_FRAME
+                continue
+
+            try:
+                delta = pending.result()
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                # Send what was already generated before the error frame
+                error = e
+                break
+            pending = asyncio.ensure_future(iterator.__anext__())
+
+            if first:
+                first = False
+                yield data_frame(delta)
+                continue
+
+            buffer.append(delta)
+            buffered_bytes += len(delta.encode("utf-8"))
+            if deadline is None:
+                deadline = time.monotonic() + flush_interval
+            if buffered_bytes >= flush_bytes:
+                yield data_frame("".join(buffer))
+                buffer, buffered_bytes, deadline = [], 0, None
+
+        if buffer:
+            yield data_frame("".join(buffer))
+        if error is not None:
+            raise error
+    finally:
+        # The client went away or the source failed: stop pulling from the source
+        if not pending.done():
+            pending.cancel()
+            with suppress(asyncio.CancelledError, StopAsyncIteration):
+                await pending
@@ -0,0 +1,17 @@
+import os
+import sys
+from pathlib import Path
+
+# Settings required at import time; the tests never reach the database, the model or the MCP server
+for name, value in {
+    "OPENAI_API_KEY": "test",
+    "DB_PASSWORD": "test",
+    "MCP_SERVER_HOST": "localhost",
+    "MCP_SERVER_PORT": "0",
+    "FASTAPI_HOST": "localhost",
+    "FASTAPI_PORT": "0",
+    "ENABLE_LOGGING": "false",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+
+from admission import AdmissionQueue
+from TokenTracker import TokenUsageTracker
+
+
+class SlowBackend:
+    """Shared budget whose take() blocks until released, like a slow database lease"""
+
+    def __init__(self):
+        self.release_take = threading.Event()
+        self.taking = threading.Event()
+        self.given = 0
+
+    def take(self, tokens: int):
+        self.taking.set()
+        self.release_take.wait(5)
+        return True
+
+    def give(self, tokens: int):
+        self.given += tokens
+
+    def release(self):
+        pass
+
+    def get_stats(self) -> dict:
+        return {}
+
+
+async def _first_event(queue: AdmissionQueue, tokens: int, session_id: str):
+    async for event in queue.admit(tokens, session_id, "main"):
+        return event
+
+
+def test_waiter_cancelled_during_slow_take_is_refunded():
+    async def scenario():
+        backend = SlowBackend()
+        tracker = TokenUsageTracker(100, backend=backend)
+        queue = AdmissionQueue(tracker, max_depth=10, max_wait=5, poll_interval=0.01, position_interval=0.01)
+
+        # Hold the budget so the next request has to queue
+        backend.release_take.set()
+        held = tracker.try_reserve(60, session_id="a")
+        admit = queue.admit(50, "b", "main")
+        assert (await admit.__anext__())[0] == "queued"
+
+        backend.release_take.clear()
+        backend.taking.clear()
+        held.refund()
+        backend.given = 0
+        queue.notify()
+        await asyncio.to_thread(backend.taking.wait, 5)
+        # The client goes away while the dispatcher is inside take()
+        await admit.aclose()
+        backend.release_take.set()
+
+        while queue._dispatcher is not None and not queue._dispatcher.done():
+            await asyncio.sleep(0.01)
+        assert queue._dispatcher.exception() is None
+        assert tracker.get_stats()["tokens_last_minute"] == 0
+        assert backend.given == 50
+
+        # The queue still admits requests afterwards
+        assert (await _first_event(queue, 50, "c"))[0] == "admitted"
+
+    asyncio.run(scenario())
+
+
+def test_fast_path_cancelled_during_slow_take_is_refunded():
+    async def scenario():
+        backend = SlowBackend()
+        tracker = TokenUsageTracker(100, backend=backend)
+        queue = AdmissionQueue(tracker, max_depth=10, max_wait=5, poll_interval=0.01, position_interval=0.01)
+
+        task = asyncio.create_task(_first_event(queue, 50, "a"))
+        await asyncio.to_thread(backend.taking.wait, 5)
+        task.cancel()
+        backend.release_take.set()
+
+        deadline = time.monotonic() + 5
+        while tracker.get_stats()["tokens_last_minute"] and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        assert tracker.get_stats()["tokens_last_minute"] == 0
+        assert backend.given == 50
+
+    asyncio.run(scenario())
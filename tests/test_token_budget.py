@@ -0,0 +1,49 @@
+import time
+
+from token_budget import PostgresTokenBudget
+from TokenTracker import TokenUsageTracker
+
+
+class FakeBudget(PostgresTokenBudget):
+    """Bucket kept in memory; fail makes every database call raise"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail = False
+        self.returned = 0
+
+    def _lease(self, amount: int) -> bool:
+        if self.fail:
+            raise ConnectionError("database down")
+        self.leased_at = time.monotonic()
+        return True
+
+    def _return(self, amount: int):
+        if self.fail:
+            raise ConnectionError("database down")
+        self.returned += amount
+
+
+def test_fail_open_reservation_gives_nothing_back():
+    budget = FakeBudget("test", 1000, lease_size=100, lease_ttl=60)
+    budget.fail = True
+    tracker = TokenUsageTracker(1000, backend=budget)
+
+    reservation = tracker.try_reserve(50)
+    assert reservation is not None
+    reservation.commit(10)
+    assert budget.leased == 0
+
+
+def test_lease_in_use_is_not_expired():
+    budget = FakeBudget("test", 1000, lease_size=100, lease_ttl=0.05)
+    assert budget.take(10) is True
+    for _ in range(4):
+        time.sleep(0.02)
+        assert budget.take(10) is True
+    budget.expire_idle()
+    assert budget.returned == 0
+
+    time.sleep(0.06)
+    budget.expire_idle()
+    assert budget.returned == 50
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_connection
+
+settings = get_settings()
+logger = get_logger()
+
+REFILL = """
+    LEAST(%(capacity)s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %(refill_rate)s)
+"""
+
+
+class PostgresTokenBudget:
+    """Token bucket shared by every worker through a row in the unlogged token_buckets table.
+
+    Each process leases chunks of lease_size tokens from the bucket and serves
+    reservations from its local lease, so most requests never touch the database.
+    Leases that sit unused for lease_ttl seconds are handed back to the bucket.
+    """
+
+    def __init__(self, name: str, limit_per_minute: int, lease_size: int, lease_ttl: float, lease_requests: int = 1):
+        self.name = name
+        self.capacity = limit_per_minute
+        self.refill_rate = limit_per_minute / 60
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.lease_requests = lease_requests
+        self.leased = 0
+        self.leased_at = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"leases": 0, "lease_failures": 0, "db_errors": 0}
+        self._initialized = False
+
+    def _params(self, amount: int) -> dict:
+        return {
+            "name": self.name,
+            "capacity": self.capacity,
+            "refill_rate": self.refill_rate,
+            "amount": amount,
+        }
+
+    def _ensure_bucket(self, cur):
+        if not self._initialized:
+            cur.execute("""
+                INSERT INTO token_buckets (name, tokens, updated_at)
+                VALUES (%(name)s, %(capacity)s, clock_timestamp())
+                ON CONFLICT (name) DO NOTHING;
+            """, self._params(0))
+            self._initialized = True
+
+    def _lease(self, amount: int) -> bool:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_bucket(cur)
+                cur.execute(f"""
+                    UPDATE token_buckets
+                    SET tokens = {REFILL} - %(amount)s,
+                        updated_at = clock_timestamp()
+                    WHERE name = %(name)s AND {REFILL} >= %(amount)s
+                    RETURNING tokens;
+                """, self._params(amount))
+                granted = cur.fetchone() is not None
+        if granted:
+            self.stats["leases"] += 1
+            self.leased_at = time.monotonic()
+        else:
+            self.stats["lease_failures"] += 1
+        return granted
+
+    def _return(self, amount: int):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE token_buckets
+                    SET tokens = LEAST(%(capacity)s, {REFILL} + %(amount)s),
+                        updated_at = clock_timestamp()
+                    WHERE name = %(name)s;
+                """, self._params(amount))
+
+    def _expire(self) -> int:
+        """Detach a lease unused for lease_ttl seconds; the caller returns it outside the lock"""
+        if self.leased > 0 and time.monotonic() - self.leased_at > self.lease_ttl:
+            expired, self.leased = self.leased, 0
+            return expired
+        return 0
+
+    def take(self, tokens: int):
+        """True when tokens were taken from the lease, False when the bucket has no room and None
+        when the database failed. Blocking: may lease from the database, so call it off the event loop.
+
+        The lock only guards the local counters; database round trips happen outside it so
+        give() and other callers never wait on one.
+        """
+        try:
+            with self.lock:
+                expired = self._expire()
+                if self.leased >= tokens:
+                    self.leased -= tokens
+                    # A lease in use is not idle; only leases nobody draws on are reaped
+                    self.leased_at = time.monotonic()
+                    shortfall = 0
+                else:
+                    shortfall = tokens - self.leased
+            if expired:
+                self._return(expired)
+            if not shortfall:
+                return True
+
+            # Lease enough for several requests of this size when possible, otherwise just the shortfall
+            chunk = min(self.capacity, max(shortfall, self.lease_size, tokens * self.lease_requests))
+            for amount in dict.fromkeys((chunk, shortfall)):
+                if self._lease(amount):
+                    with self.lock:
+                        self.leased += amount - tokens
+                    return True
+            return False
+        except Exception as e:
+            # Fail open: the per-process window in TokenUsageTracker still applies. Nothing was
+            # leased, so the reservation must not give tokens back to the lease on settle
+            self.stats["db_errors"] += 1
+            logger.error(f"(API) Shared token budget unavailable, admitting locally: {e}")
+            return None
+
+    def expire_idle(self):
+        """Hand a lease nobody has used for lease_ttl seconds back to the shared bucket"""
+        with self.lock:
+            expired = self._expire()
+        if expired:
+            try:
+                self._return(expired)
+            except Exception as e:
+                logger.error(f"(API) Failed to return expired lease: {e}")
+
+    async def run_reaper(self):
+        """Background task started from the lifespan hook, so idle workers do not sit on leases"""
+        while True:
+            await asyncio.sleep(self.lease_ttl)
+            await asyncio.to_thread(self.expire_idle)
+
+    def give(self, tokens: int):
+        """Return unused tokens to the local lease (negative amounts record usage above the reservation)"""
+        with self.lock:
+            self.leased += tokens
+
+    def release(self):
+        with self.lock:
+            if self.leased > 0:
+                try:
+                    self._return(self.leased)
+                except Exception as e:
+                    logger.error(f"(API) Failed to return leased tokens: {e}")
+            self.leased = 0
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "leased": self.leased}
@@ -0,0 +1,52 @@
+from functools import lru_cache
+
+from langchain_core.messages import BaseMessage
+
+from settings import get_settings
+from llm_logger import get_logger
+
+settings = get_settings()
+logger = get_logger()
+
+# OpenAI chat format overhead: every message is wrapped in role/separator tokens,
+# and every reply is primed with a few more
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    # tiktoken downloads its BPE files on first use, so any load (not only the fallback) can fail on an
+    # offline host; estimate by characters then instead of failing every request
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(settings.LLM_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.error(f"(API) Failed to load tiktoken encoding, falling back to character estimate: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=128)
+def count_prompt_tokens(system_prompt: str) -> int:
+    """Token count of a formatted system prompt, cached since the schema part rarely changes"""
+    return count_tokens(system_prompt) + TOKENS_PER_MESSAGE
+
+
+def count_message_tokens(messages: list[BaseMessage]) -> int:
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        total += count_tokens(content) + TOKENS_PER_MESSAGE
+    return total
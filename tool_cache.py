@@ -0,0 +1,133 @@
+import re
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from settings import get_settings
+from llm_logger import get_logger
+
+if TYPE_CHECKING:
+    from langchain_core.tools import BaseTool
+
+settings = get_settings()
+logger = get_logger()
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Quoted SQL literals and identifiers (unterminated ones run to the end), whose whitespace is significant
+QUOTED_PATTERN = re.compile(r"""('(?:[^']|'')*(?:'|$)|"(?:[^"]|"")*(?:"|$))""")
+
+
+def _normalize_value(value):
+    if isinstance(value, str):
+        # Formatting-only differences in generated SQL should hit the same entry; odd parts are quoted
+        parts = QUOTED_PATTERN.split(value)
+        parts[::2] = [WHITESPACE_PATTERN.sub(" ", part) for part in parts[::2]]
+        return "".join(parts).strip().rstrip(";").strip()
+    return value
+
+
+class _OwnerCancelled(Exception):
+    """Set on a shared call whose caller was cancelled, so a waiter runs it instead"""
+
+
+class ToolResultCache:
+    """LRU cache of MCP tool results keyed by db_name, tool name and normalised arguments.
+
+    Identical concurrent calls share one in-flight request. Failed calls raise and are not cached;
+    when the caller running a shared request is cancelled, one of its waiters takes it over.
+    """
+
+    def __init__(self, max_size: int, ttl: float, excluded_tools: set[str]):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.excluded_tools = excluded_tools
+        # key -> {"result", "created_at", "elapsed"}
+        self._entries = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "shared": 0, "time_saved": 0.0, "invalidated": 0}
+
+    @staticmethod
+    def make_key(db_name: str, tool_name: str, arguments: dict) -> tuple:
+        normalized = {name: _normalize_value(value) for name, value in arguments.items()}
+        return db_name, tool_name, json.dumps(normalized, sort_keys=True, default=str)
+
+    async def call(self, db_name: str, tool_name: str, arguments: dict, call):
+        key = self.make_key(db_name, tool_name, arguments)
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry["created_at"] <= self.ttl:
+                self.stats["hits"] += 1
+                self.stats["time_saved"] += entry["elapsed"]
+                self._entries.move_to_end(key)
+                logger.info(f"(API) Tool cache hit for {tool_name} on '{db_name}', saved {entry['elapsed']:.3f}s")
+                return entry["result"]
+
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            try:
+                result = await asyncio.shield(pending)
+                self.stats["shared"] += 1
+                return result
+            except _OwnerCancelled:
+                # The first waiter to get here starts the call again; the others share it
+                continue
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        start_time = time.perf_counter()
+        try:
+            result = await call(**arguments)
+        except asyncio.CancelledError:
+            future.set_exception(_OwnerCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting on it
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(result)
+        self._entries[key] = {"result": result, "created_at": time.monotonic(), "elapsed": time.perf_counter() - start_time}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return result
+
+    def wrap(self, tool: "BaseTool", db_name: str) -> "BaseTool":
+        """A copy of an MCP tool whose calls go through the cache; excluded tools are returned unchanged"""
+        from langchain_core.tools import StructuredTool
+        if self.ttl <= 0 or tool.name in self.excluded_tools or not isinstance(tool, StructuredTool) or tool.coroutine is None:
+            return tool
+
+        original = tool.coroutine
+
+        async def cached_call(**arguments):
+            return await self.call(db_name, tool.name, arguments, original)
+
+        return tool.model_copy(update={"coroutine": cached_call})
+
+    def invalidate(self, db_name: str = None) -> int:
+        """Drop cached results for db_name, or all of them; call when the underlying data changes"""
+        keys = [key for key in self._entries if db_name is None or key[0] == db_name]
+        for key in keys:
+            del self._entries[key]
+        self.stats["invalidated"] += len(keys)
+        logger.info(f"(API) Invalidated {len(keys)} cached tool results for: {db_name or 'all databases'}")
+        return len(keys)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "size": len(self._entries)}
+
+
+tool_cache = ToolResultCache(
+    max_size=settings.TOOL_CACHE_SIZE,
+    ttl=settings.TOOL_CACHE_TTL,
+    excluded_tools={tool.strip() for tool in settings.TOOL_CACHE_EXCLUDED_TOOLS.split(",") if tool.strip()},
+)
@@ -1,43 +1,56 @@
-import psycopg2
-from settings import Settings
-from llm_logger import LLMLogger
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import json
+from settings import get_settings
+from llm_logger import get_logger
+from db_pool import get_async_pool
 
-settings = Settings()
-logger = LLMLogger()
+settings = get_settings()
+logger = get_logger()
+
+# The API's own tables, never shown to the model as queryable schema; partitions of them
+# (and of any user table) are filtered separately with pg_class.relispartition
+INTERNAL_TABLES = [
+    "app_logs",
+    settings.DB_CHAT_HISTORY_TABLE,
+    "llm_logs",
+    "modified_files",
+    "uploaded_files",
+    "token_buckets",
+    "upload_chunks",
+    "blobs",
+    "schema_version",
+]
 
 class UserRepository:
     def __init__(self, dbname: str = settings.DB_NAME):
-        self.connection_params = {
-            "host": settings.DB_HOST,
-            "port": settings.DB_PORT,
-            "user": settings.DB_USER,
-            "password": settings.DB_PASSWORD,
-            "dbname": dbname,
-        }
+        self.dbname = dbname
+        self.pool = None
         self.conn = None
+        
+    
+    async def __aenter__(self):
         try:
-            self.conn = psycopg2.connect(**self.connection_params)
-            logger.info("(API) Database connection established.")
+            self.pool = await get_async_pool(self.dbname)
+            self.conn = await self.pool.getconn()
+            logger.info("(API) Database connection borrowed from pool.")
         except Exception as e:
             logger.error(f"[UserRepository] Failed to connect to database: {e}")
-        
-    
-    def __enter__(self):
         return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
+    async def __aexit__(self, exc_type, exc_value, traceback):
         if self.conn:
-            self.conn.close()
-            logger.info("(API) Database connection closed.")
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                await self.conn.rollback()
+            await self.pool.putconn(self.conn)
+            logger.info("(API) Database connection returned to pool.")
 
         
-    def get_tables_info(self):
+    async def get_tables_metadata(self):
+        """Public tables as [{"table", "comment", "columns": [(name, dtype, comment)]}], or None on failure"""
         logger.info("(API) Fetching table and column info.")
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.conn.cursor() as cursor:
+                await cursor.execute("""
                     SELECT 
                     b.table_comment as table_desc, 
                     a.table_name,column_name,data_type,column_desc FROM 
@@ -47,6 +60,7 @@ class UserRepository:
                         c.table_name,
                         c.column_name,
                         c.data_type,
+                        c.ordinal_position,
                         pgd.description AS column_desc
                     FROM 
                         information_schema.columns c
@@ -56,6 +70,7 @@ class UserRepository:
                         pg_catalog.pg_description pgd ON pgd.objoid = st.relid AND pgd.objsubid = c.ordinal_position
                     WHERE 
                         c.table_schema = 'public' --and pgd.description is not null and objoid = 17053
+                        AND NOT coalesce((SELECT relispartition FROM pg_catalog.pg_class WHERE oid = st.relid), false)
 
                     ) as a
 
@@ -76,75 +91,97 @@ class UserRepository:
                         AND ns.nspname = 'public'
                         AND des.description IS NOT NULL
                     ) b on a.objoid  = b.oid
-                    where a.table_name  not in ('app_logs', 'chat_history', 'llm_logs', 'modified_files', 'uploaded_files')
-                """)
-                rows = cursor.fetchall()
+                    where a.table_name <> ALL(%s)
+                    order by a.table_name, a.ordinal_position
+                """, (INTERNAL_TABLES,))
+                rows = await cursor.fetchall()
             table_dict = {}
             for table_comment, table, column, dtype, column_comment in rows:
                 table_dict.setdefault((table, table_comment), []).append((column, dtype, column_comment))
         except Exception as e:
             logger.error(f"(API) Failed to fetch table and column info: {e}")
-            return " "
-        
-        return "\n\n".join(
-            f"Table: {table} -- {table_comment}\n" + "\n".join(
-                f"  - {col} ({dtype})" + (f" -- {comment}" if comment else "")
-                for col, dtype, comment in cols
-            )
+            return None
+
+        return [
+            {"table": table, "comment": table_comment, "columns": cols}
             for (table, table_comment), cols in table_dict.items()
-        )
+        ]
     
-    def estimate_tokens(self):
-        logger.info('(API) Fetching token amount of last call')
+    async def get_schema_fingerprint(self):
+        """Cheap hash of the public schema's catalog rows; changes whenever a table, column or comment changes.
+
+        Covers every relation kind information_schema.columns (and so the prompt) can show: tables,
+        partitioned tables, views, materialized views and foreign tables.
+        """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                               SELECT total_tokens
-                               FROM llm_logs
-                               ORDER BY timestamp DESC
-                               LIMIT 1
-                               """)
-                row = cursor.fetchone()
+            async with self.conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT md5(coalesce(string_agg(entry, ',' ORDER BY entry), ''))
+                    FROM (
+                        SELECT cls.oid::text || ':' || cls.xmin::text AS entry
+                        FROM pg_catalog.pg_class cls
+                        JOIN pg_catalog.pg_namespace ns ON ns.oid = cls.relnamespace
+                        WHERE ns.nspname = 'public' AND cls.relkind IN ('r', 'p', 'v', 'm', 'f') AND NOT cls.relispartition AND cls.relname <> ALL(%(internal)s)
+                        UNION ALL
+                        SELECT att.attrelid::text || '.' || att.attnum::text || ':' || att.xmin::text
+                        FROM pg_catalog.pg_attribute att
+                        JOIN pg_catalog.pg_class cls ON cls.oid = att.attrelid
+                        JOIN pg_catalog.pg_namespace ns ON ns.oid = cls.relnamespace
+                        WHERE ns.nspname = 'public' AND cls.relkind IN ('r', 'p', 'v', 'm', 'f') AND NOT cls.relispartition AND cls.relname <> ALL(%(internal)s) AND att.attnum > 0
+                        UNION ALL
+                        SELECT des.objoid::text || '.' || des.objsubid::text || ':' || des.xmin::text
+                        FROM pg_catalog.pg_description des
+                        JOIN pg_catalog.pg_class cls ON cls.oid = des.objoid
+                        JOIN pg_catalog.pg_namespace ns ON ns.oid = cls.relnamespace
+                        WHERE ns.nspname = 'public' AND cls.relkind IN ('r', 'p', 'v', 'm', 'f') AND NOT cls.relispartition AND cls.relname <> ALL(%(internal)s)
+                    ) AS catalog_rows
+                """, {"internal": INTERNAL_TABLES})
+                row = await cursor.fetchone()
         except Exception as e:
-            logger.error(f"(API) Failed to get last token call usage: {e}")
-            return 0
+            logger.error(f"(API) Failed to fetch schema fingerprint: {e}")
+            if self.conn:
+                await self.conn.rollback()
+            return None
 
-        if row and row[0] is not None:
-            return row[0]
-        else:
-            return 15000
-        
-    def get_database_names(self):
+        return row[0] if row else None
+
+    async def get_database_names(self):
         logger.info("(API) Fetching database names.")
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
+            async with self.conn.cursor() as cursor:
+                await cursor.execute("""
                     SELECT id, database_name, description, default_db FROM available_databases;
                 """)
                 columns = [desc[0] for desc in cursor.description]
-                rows = cursor.fetchall()
+                rows = await cursor.fetchall()
             result = [dict(zip(columns, row)) for row in rows]
             return result
         except Exception as e:
             logger.error(f"(API) Failed to fetch database names: {e}")
             return []
                 
-    def get_uploaded_data(self, session_id: str) -> dict:
+    async def get_uploaded_data(self, session_id: str) -> dict:
         logger.info(f"(API) Fetching uploaded data for session: {session_id}") 
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "SELECT data, file_type, filename FROM uploaded_files WHERE session_id = %s ORDER BY upload_time DESC LIMIT 1",
+        async with self.conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT u.id, u.file_type, u.filename, u.content_kind, u.chunk_count, u.parsed_blob
+                FROM uploaded_files u
+                WHERE u.session_id = %s ORDER BY u.upload_time DESC LIMIT 1
+                """,
                 (session_id,)
             )
-            result = cur.fetchone()
+            result = await cur.fetchone()
             file_dict = {}
             if result:
                 file_dict = {
-                    "data": result[0],  # JSON string
+                    "id": result[0],
                     "file_type": result[1],
                     "filename": result[2],
+                    "kind": result[3] or "text",
+                    "chunk_count": result[4],  # set when the upload is indexed in upload_chunks
+                    "parsed_blob": result[5],  # content hash, shared by identical uploads
                 }
                 return file_dict
 
             return None
-        
\ No newline at end of file